@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Under GPL licence.
+
+Benchmark of every stage of the pipeline on synthetic plates. The results
+are added to a json history file and compared with the previous run, so
+regressions show up between versions.
+
+    python benchmark.py --sizes 96 384 1536 --blocks 3 --points 60
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import numpy as np
+from modules.measurement import Measurement
+from modules.synthetic import write_plate
+from modules.excel import XLSX_AVAILABLE
+
+
+# Stages taken from the profiler records of the measurement
+STAGES = ('read_measurement_datafile',
+          'read_label_file',
+          'calculate_baseline',
+          'calculate_response',
+          'calculate_mean_curve',
+          'calculate_slope',
+          'save_datafile',
+          'plot_data',
+         )
+# A stage is reported as slower above this ratio to the previous run
+REGRESSION_LIMIT = 1.2
+
+
+def version_name():
+    """
+    Git commit of the code if it is available
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                             cwd = os.path.dirname(os.path.abspath(__file__)),
+                                             stderr = devnull)
+        return commit.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+### ======================================================================== ###
+
+def run_plate(datafilename, label_filename, folder, options):
+    """
+    The whole pipeline of one plate, returns the wall time of each stage
+    """
+    measurement = Measurement()
+    measurement.workers = options.workers
+    #
+    measurement.read_measurement_datafile(datafilename)
+    measurement.read_label_datafile(label_filename, 30)
+    extension = '.xlsx' if XLSX_AVAILABLE else '.xls'
+    measurement.save_datafile(os.path.join(folder, 'benchmark_analyzed' + extension))
+    if not options.no_plot:
+        measurement.plot_data('benchmark', folder, options.profile, reuse = False)
+    # ---------------------------
+    # Whole stages only (not the blocks)
+    # ---------------------------
+    timing = {}
+    for record in measurement.profiler.records:
+        if (record['block'] is None) and (record['stage'] in STAGES):
+            timing[record['stage']] = timing.get(record['stage'], 0.0) + record['wall_time']
+    #
+    return timing
+### ======================================================================== ###
+
+def run_benchmark(options):
+    """
+    Best of the repeats for each plate size
+    """
+    folder = tempfile.mkdtemp(prefix = 'plate_benchmark_')
+    results = {}
+    try:
+        for plate_size in options.sizes:
+            datafilename, label_filename = write_plate(folder, plate_size, options.blocks, options.points,
+                                                       options.missing)
+            best = {}
+            for _ in xrange(options.repeat):
+                timing = run_plate(datafilename, label_filename, folder, options)
+                for stage in timing:
+                    best[stage] = min(best.get(stage, np.inf), timing[stage])
+            results[str(plate_size)] = best
+    finally:
+        shutil.rmtree(folder, ignore_errors = True)
+    #
+    return results
+### ======================================================================== ###
+
+def load_history(filename):
+    """
+    """
+    if not os.path.isfile(filename):
+        return []
+    with open(filename, 'r') as historyfile:
+        history = json.load(historyfile)
+    #
+    return history
+### ======================================================================== ###
+
+def report(entry, previous):
+    """
+    Table of the stages, compared with the previous run of the same settings
+    """
+    lines = []
+    for plate_size in sorted(entry['results'], key = int):
+        lines.append('')
+        lines.append(plate_size + ' well plate')
+        lines.append('%-28s %10s %10s %8s' % ('stage', 'time (s)', 'previous', 'ratio'))
+        for stage in STAGES:
+            if stage not in entry['results'][plate_size]:
+                continue
+            seconds = entry['results'][plate_size][stage]
+            line = '%-28s %10.3f' % (stage, seconds)
+            if previous is not None and stage in previous['results'].get(plate_size, {}):
+                before = previous['results'][plate_size][stage]
+                ratio = seconds / before if before > 0 else np.inf
+                line += ' %10.3f %8.2f' % (before, ratio)
+                if ratio > REGRESSION_LIMIT:
+                    line += '  SLOWER'
+            lines.append(line)
+    #
+    return '\n'.join(lines)
+### ======================================================================== ###
+
+def main(arguments = None):
+    """
+    """
+    parser = argparse.ArgumentParser(description = 'Benchmark the stages of the plate analysis')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [96, 384, 1536],
+                        help = 'plate formats (default: 96 384 1536)')
+    parser.add_argument('--blocks', type = int, default = 3, help = 'number of blocks (default: 3)')
+    parser.add_argument('--points', type = int, default = 60, help = 'time points in each block (default: 60)')
+    parser.add_argument('--missing', type = int, default = 0, help = 'number of wells with missing values')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'the best of this many runs (default: 3)')
+    parser.add_argument('--workers', type = int, default = 1, help = 'Measurement.workers (default: 1)')
+    parser.add_argument('--profile', choices = ('publication', 'preview'), default = 'publication',
+                        help = 'render profile of the figures (default: publication)')
+    parser.add_argument('--no-plot', action = 'store_true', help = 'do not time plot_data')
+    parser.add_argument('--history', default = 'benchmark_history.json',
+                        help = 'json file of the results of the runs (default: benchmark_history.json)')
+    parser.add_argument('--name', default = None, help = 'name of this run (default: the git commit)')
+    options = parser.parse_args(arguments)
+    #
+    settings = {'blocks' : options.blocks,
+                'points' : options.points,
+                'missing' : options.missing,
+                'workers' : options.workers,
+                'profile' : None if options.no_plot else options.profile,
+               }
+    entry = {'name' : options.name or version_name(),
+             'date' : datetime.datetime.now().isoformat(),
+             'python' : platform.python_version(),
+             'numpy' : np.__version__,
+             'settings' : settings,
+             'results' : run_benchmark(options),
+            }
+    # ---------------------------
+    # Compare with the last run of the same settings
+    # ---------------------------
+    history = load_history(options.history)
+    previous = None
+    for old_entry in reversed(history):
+        if old_entry['settings'] == settings:
+            previous = old_entry
+            break
+    print report(entry, previous)
+    #
+    history.append(entry)
+    with open(options.history, 'w') as historyfile:
+        json.dump(history, historyfile, indent = 1, sort_keys = True)
+    #
+    return 0
+### ======================================================================== ###
+
+if __name__ == "__main__":
+    sys.exit(main())
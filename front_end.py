@@ -9,7 +9,12 @@ Under GPL licence.
 import wx
 from wx.lib.intctrl import IntCtrl
 import os
+import threading
+import Queue
 from modules.measurement import Measurement
+from modules.measurement import MeasurementCancelled
+from modules.cache import PlateCache
+from modules.excel import XLSX_AVAILABLE
 
 
 class FrontEnd(wx.Frame):
@@ -18,17 +23,30 @@ class FrontEnd(wx.Frame):
     def __init__(self):
         """
         """
-        self.PlateReader = Measurement()
+        # ---------------------
+        # Every stage runs in the background, one after the other, so the
+        # next plate can be queued while the previous one is saved
+        # ---------------------
+        self.tasks = Queue.Queue()
+        # Cancel events of the queued and running tasks
+        self.task_events = []
+        self.PlateCache = PlateCache()
+        self.PlateReader = self.new_measurement()
+        self.save_filename = ''
+        #
+        self.worker = threading.Thread(target = self.run_tasks)
+        self.worker.daemon = True
+        self.worker.start()
 
         wx.Frame.__init__(self, None, wx.ID_ANY, "Kinetic measurement converter",
-                          size = (465, 400), style = wx.CAPTION | wx.MINIMIZE_BOX |wx.CLOSE_BOX)
+                          size = (465, 430), style = wx.CAPTION | wx.MINIMIZE_BOX |wx.CLOSE_BOX)
         self.Centre()
         #
         splitter = wx.SplitterWindow(self, -1, style=wx.SP_3D)
         #
         panel1 = wx.Panel(splitter, wx.ID_ANY, size =(460,180))
         panel2 = wx.Panel(splitter, wx.ID_ANY, size =(460,280))
-        splitter.SplitHorizontally(panel1, panel2, 65)
+        splitter.SplitHorizontally(panel1, panel2, 95)
         # ---------------------
         # 1. Load datafile
         # ---------------------
@@ -60,6 +78,14 @@ class FrontEnd(wx.Frame):
         self.button_plot = wx.Button(panel1, id=wx.ID_ANY, label="5. Plot figures", pos=(305,35), size=(150,30))
         self.button_plot.Bind(wx.EVT_BUTTON, self.onButton_plot)
         self.button_plot.Hide()
+        # ---------------------
+        # Progress of the running stage
+        # ---------------------
+        self.progress = wx.Gauge(panel1, id=wx.ID_ANY, range=1000, pos=(5,68), size=(280,20))
+        self.status = wx.StaticText(panel1, id=wx.ID_ANY, pos=(290,70), size=(85,20), label='')
+        self.button_cancel = wx.Button(panel1, id=wx.ID_ANY, label="Cancel", pos=(380,65), size=(75,25))
+        self.button_cancel.Bind(wx.EVT_BUTTON, self.onButton_cancel)
+        self.button_cancel.Disable()
 
 
         self.edit = wx.TextCtrl(panel2, id = wx.ID_ANY, pos=(5,0), size=(450, 300), style = wx.TE_MULTILINE|wx.TE_READONLY|wx.TE_AUTO_URL)
@@ -71,6 +97,117 @@ class FrontEnd(wx.Frame):
         #
         return None
     ### ========================================================================
+    def new_measurement(self):
+        """
+        Each plate has its own Measurement, the queued stages of the previous
+        plate keep working on theirs
+        """
+        measurement = Measurement()
+        measurement.cache = self.PlateCache
+        # No process pools: forking the wx process from the background
+        # thread is not safe
+        measurement.workers = 1
+        measurement.progress = self.report_progress
+        #
+        return measurement
+    ### ========================================================================
+    def add_task(self, description, measurement, function, done = None):
+        """
+        Run the function in the background, done is called with its result
+        in the event thread when it is finished. Each task has its own cancel
+        event, it becomes the cancel event of the measurement while the task
+        runs.
+        """
+        cancel = threading.Event()
+        self.task_events.append(cancel)
+        self.tasks.put((description, measurement, function, done, cancel))
+        self.button_cancel.Enable()
+        #
+        return None
+    ### ========================================================================
+    def run_tasks(self):
+        """
+        Background thread: runs the queued tasks one after the other
+        """
+        while True:
+            description, measurement, function, done, cancel = self.tasks.get()
+            measurement.cancel = cancel
+            wx.CallAfter(self.show_progress, description, 0, 1)
+            try:
+                # Cancelled before it started
+                if cancel.is_set():
+                    raise MeasurementCancelled(description)
+                result = function()
+            except MeasurementCancelled:
+                finished = (self.task_finished, description + ' cancelled', None, None)
+            except Exception as error:
+                finished = (self.task_failed, description, error)
+            else:
+                finished = (self.task_finished, description + ' done', done, result)
+            # Done before the event thread checks the number of queued tasks
+            self.task_events.remove(cancel)
+            self.tasks.task_done()
+            wx.CallAfter(*finished)
+        #
+        return None
+    ### ========================================================================
+    def report_progress(self, stage, done, total):
+        """
+        Progress callback of the measurements, it is called by the background
+        thread
+        """
+        wx.CallAfter(self.show_progress, stage, done, total)
+        #
+        return None
+    ### ========================================================================
+    def show_progress(self, stage, done, total):
+        """
+        """
+        self.status.SetLabel(stage)
+        self.progress.SetValue(int(1000 * done / max(total, 1)))
+        #
+        return None
+    ### ========================================================================
+    def task_finished(self, message, done, result):
+        """
+        """
+        self.status.SetLabel(message)
+        self.progress.SetValue(0)
+        if self.tasks.unfinished_tasks == 0:
+            self.button_cancel.Disable()
+        if done is not None:
+            done(result)
+        #
+        return None
+    ### ========================================================================
+    def task_failed(self, description, error):
+        """
+        """
+        self.task_finished(description + ' failed', None, None)
+        wx.MessageBox(str(error), description + ' failed', wx.OK | wx.ICON_ERROR)
+        #
+        return None
+    ### ========================================================================
+    def onButton_cancel(self, event):
+        """
+        Stop the running stage and drop the queued ones. The events of every
+        task are set, so a task just taken by the background thread is
+        stopped too.
+        """
+        for cancel in list(self.task_events):
+            cancel.set()
+        while True:
+            try:
+                cancel = self.tasks.get_nowait()[-1]
+            except Queue.Empty:
+                break
+            self.task_events.remove(cancel)
+            self.tasks.task_done()
+        if self.button_save.Label == '4. Saving...':
+            self.button_save.Label = '4. Save converted data'
+        #
+        return None
+    ### ========================================================================
     def onButton_data(self, event):
         """
         This method is fired when its corresponding button is pressed
@@ -84,16 +221,34 @@ class FrontEnd(wx.Frame):
                                       )
         #
         if openFileDialog.ShowModal() != wx.ID_CANCEL:
+            datafilename = openFileDialog.GetPath()
             #
-            self.PlateReader.read_measurement_datafile(openFileDialog.GetPath())
+            self.PlateReader = self.new_measurement()
+            measurement = self.PlateReader
             #
-            self.data_filename = os.path.basename(openFileDialog.GetPath()).split('.')[0]
-            self.save_filename = openFileDialog.GetPath().split('.')[0] + '_analyzed.xls'
+            self.data_filename = os.path.basename(datafilename).split('.')[0]
+            if XLSX_AVAILABLE:
+                self.save_filename = datafilename.split('.')[0] + '_analyzed.xlsx'
+            else:
+                self.save_filename = datafilename.split('.')[0] + '_analyzed.xls'
             #
-            self.button_label.Show()
-            self.edit.Show()
-            self.edit.SetValue(self.PlateReader.info())
+            self.button_label.Hide()
+            self.button_save.Hide()
+            self.button_plot.Hide()
             self.button_save.Label = '4. Save converted data'
+            #
+            # The info text is made in the background too, the next stage
+            # may already be running when it is shown
+            def load():
+                measurement.read_measurement_datafile(datafilename)
+                return measurement.info()
+            def done(info):
+                if measurement is self.PlateReader:
+                    self.button_label.Show()
+                    self.edit.Show()
+                    self.edit.SetValue(info)
+                return None
+            self.add_task('1. Loading', measurement, load, done)
         #
         openFileDialog.Destroy()
         #
@@ -112,13 +267,20 @@ class FrontEnd(wx.Frame):
                                       )
         #
         if openFileDialog.ShowModal() != wx.ID_CANCEL:
+            label_filename = openFileDialog.GetPath()
+            addition_time = self.addition_time.GetValue()
+            measurement = self.PlateReader
             #
-            self.PlateReader.read_label_datafile(openFileDialog.GetPath(), self.addition_time.GetValue())
-            #
-            self.button_save.Show()
-            self.button_plot.Show()
-            #
-            self.edit.SetValue(self.PlateReader.info())
+            def load():
+                measurement.read_label_datafile(label_filename, addition_time)
+                return measurement.info()
+            def done(info):
+                if measurement is self.PlateReader:
+                    self.button_save.Show()
+                    self.button_plot.Show()
+                    self.edit.SetValue(info)
+                return None
+            self.add_task('3. Labels', measurement, load, done)
         #
         openFileDialog.Destroy()
         #
@@ -128,7 +290,12 @@ class FrontEnd(wx.Frame):
         """
         This method is fired when its corresponding button is pressed
         """
-        self.PlateReader.plot_data(self.data_filename, os.path.dirname(self.save_filename))
+        measurement = self.PlateReader
+        data_filename = self.data_filename
+        folder_name = os.path.dirname(self.save_filename)
+        #
+        self.add_task('5. Plotting', measurement,
+                      lambda: measurement.plot_data(data_filename, folder_name))
         #
         return None
     ### ========================================================================
@@ -138,16 +305,18 @@ class FrontEnd(wx.Frame):
         """
         if self.save_filename != '':
             self.button_save.Label = '4. Saving...'
-            add_time = self.addition_time.GetValue()
-            #
-            self.PlateReader.save_datafile(self.save_filename)
+            measurement = self.PlateReader
+            save_filename = self.save_filename
             #
-            self.button_save.Label = '4. Saved'
+            def done(result):
+                if measurement is self.PlateReader:
+                    self.button_save.Label = '4. Saved'
+                return None
+            self.add_task('4. Saving', measurement,
+                          lambda: measurement.save_datafile(save_filename),
+                          done)
         #
         return None
     ### ========================================================================
     ### ========================================================================
     ### ========================================================================
-
-
-
@@ -3,14 +3,22 @@
 """
 Created by Zoltan Bozoky 2015.04.14.
 Under GPL licence.
+
+Without arguments the graphical front end starts, with arguments the plates
+are processed from the command line (see: python kinetic_measurements.py -h)
 """
 
-import wx
-from front_end import FrontEnd
+import sys
 
 
 # Run the program
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        from modules.cli import main
+        sys.exit(main(sys.argv[1:]))
+    # wx is only needed by the front end
+    import wx
+    from front_end import FrontEnd
     app = wx.App(False)
     frame = FrontEnd()
     frame.Show()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Under GPL licence.
+
+Purpose:
+========
+Batch processing of many plates in parallel processes. The plates are listed
+in a manifest (csv) file:
+
+    datafile,labelfile,addition_time
+    day1/plate1.xls,day1/labels.xls,30
+    day1/plate2.xls,day1/labels.xls,
+
+Relative paths are relative to the manifest file, an empty addition time
+means the default. A failing plate is reported but the others are finished. Plates which would
+write the same output files (a data file listed twice, or data files with the
+same name and one output folder) get their number in the manifest after their
+name.
+Besides the workbooks and figures of the plates, three summary files are
+written: the status and timing of each plate, the group statistics of every
+plate in one table and the time and memory of the stages of each plate.
+
+"""
+
+import copy
+import csv
+import os
+import time
+import traceback
+from multiprocessing import Pool
+from modules.cli import output_names
+from modules.cli import process_plate
+from modules.cli import save_timing
+from modules.cli import timing_entry
+
+
+# Summary file names
+SUMMARY_FILENAME = 'batch_summary.csv'
+STATISTICS_FILENAME = 'batch_statistics.csv'
+TIMING_FILENAME = 'batch_timing.json'
+
+
+def read_manifest(manifest_filename, default_addition_time = 30):
+    """
+    List of (data file, label file, addition time) of the plates
+    """
+    folder = os.path.dirname(os.path.abspath(manifest_filename))
+    jobs = []
+    with open(manifest_filename, 'rb') as manifestfile:
+        for line_number, row in enumerate(csv.DictReader(manifestfile), 2):
+            datafilename = (row.get('datafile') or '').strip()
+            label_filename = (row.get('labelfile') or '').strip()
+            if not datafilename:
+                continue
+            if not label_filename:
+                raise ValueError(manifest_filename + ' line ' + str(line_number) + ': no label file')
+            addition_time = (row.get('addition_time') or '').strip()
+            if addition_time:
+                addition_time = int(addition_time)
+            else:
+                addition_time = default_addition_time
+            jobs.append((os.path.join(folder, datafilename),
+                         os.path.join(folder, label_filename),
+                         addition_time))
+    #
+    return jobs
+### ======================================================================== ###
+
+def analyse_plate(arguments):
+    """
+    Worker of the pool: the whole pipeline of one plate. Every error is
+    caught, the result is a dict with the status, timing, written files, the
+    group statistics rows and the stage records of the plate.
+    """
+    number, datafilename, label_filename, addition_time, name, options = arguments
+    plate_options = copy.copy(options)
+    plate_options.addition_time = addition_time
+    # Pool processes can not start their own processes
+    plate_options.workers = 1
+    #
+    result = {'number' : number,
+              'datafile' : datafilename,
+              'labelfile' : label_filename,
+              'addition_time' : addition_time,
+              'status' : 'ok',
+              'error' : '',
+              'outputs' : [],
+              'statistics' : [],
+              'timing' : timing_entry(datafilename, label_filename, name, []),
+             }
+    start = time.time()
+    try:
+        measurement, result['outputs'] = process_plate(datafilename, label_filename, plate_options, name)
+        result['statistics'] = statistics_rows(measurement)
+        result['timing']['stages'] = measurement.profiler.records
+    except Exception as error:
+        result['status'] = 'failed'
+        result['error'] = ''.join((error.__class__.__name__, ': ', str(error)))
+        print traceback.format_exc()
+    result['seconds'] = time.time() - start
+    #
+    return result
+### ======================================================================== ###
+
+def statistics_rows(measurement):
+    """
+    [statistic, block, group, mean, std, number of wells] rows of the plate
+    """
+    rows = []
+    for group in sorted(measurement.baseline):
+        values = measurement.baseline[group]
+        rows.append(['baseline', '', group,
+                     float(values['mean'][0]), float(values['std'][0]), int(values['len'][0])])
+    for name, statistics in (('response', measurement.response),
+                             ('slope', measurement.start_slope)):
+        for block in sorted(statistics):
+            for group in sorted(statistics[block]):
+                values = statistics[block][group]
+                rows.append([name, measurement.data[block].block_name, group,
+                             float(values['mean'][0]), float(values['std'][0]), int(values['len'][0])])
+    #
+    return rows
+### ======================================================================== ###
+
+def run_batch(jobs, options, workers = 1, summary_folder = '.'):
+    """
+    Analyse the (data file, label file, addition time) plates in the given
+    number of processes, returns the list of the plate results
+    """
+    names = output_names([job[0] for job in jobs], options.output_folder)
+    arguments = [(number, datafilename, label_filename, addition_time, name, options)
+                 for number, ((datafilename, label_filename, addition_time), name)
+                 in enumerate(zip(jobs, names))]
+    results = []
+    # ---------------------------
+    # Plates in parallel, reported as they finish
+    # ---------------------------
+    if workers > 1 and len(arguments) > 1:
+        pool = Pool(min(workers, len(arguments)))
+        try:
+            for result in pool.imap_unordered(analyse_plate, arguments):
+                report(result, len(results) + 1, len(arguments))
+                results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for argument in arguments:
+            result = analyse_plate(argument)
+            report(result, len(results) + 1, len(arguments))
+            results.append(result)
+    # ---------------------------
+    # Summary in the manifest order
+    # ---------------------------
+    results.sort(key = lambda result: result['number'])
+    write_summary(results, summary_folder)
+    #
+    return results
+### ======================================================================== ###
+
+def report(result, number, total):
+    """
+    """
+    print ''.join(('[', str(number), '/', str(total), '] ',
+                   result['datafile'], ' ', result['status'],
+                   ' (', str(round(result['seconds'], 1)), ' sec)'))
+    if result['error']:
+        print '    ', result['error']
+    #
+    return None
+### ======================================================================== ###
+
+def write_summary(results, folder):
+    """
+    Status and timing of the plates, the statistics of all plates and the
+    stage records of the plates
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    #
+    with open(os.path.join(folder, SUMMARY_FILENAME), 'wb') as summaryfile:
+        writer = csv.writer(summaryfile)
+        writer.writerow(['datafile', 'labelfile', 'addition_time', 'status', 'seconds', 'error', 'outputs'])
+        for result in results:
+            writer.writerow([result['datafile'], result['labelfile'], result['addition_time'],
+                             result['status'], round(result['seconds'], 3), result['error'],
+                             ';'.join(result['outputs'])])
+    #
+    with open(os.path.join(folder, STATISTICS_FILENAME), 'wb') as statisticsfile:
+        writer = csv.writer(statisticsfile)
+        writer.writerow(['datafile', 'statistic', 'block', 'group', 'mean', 'std', 'number_of_wells'])
+        for result in results:
+            for row in result['statistics']:
+                writer.writerow([result['datafile']] + [value.encode('utf-8') if isinstance(value, unicode) else value
+                                                         for value in row])
+    #
+    save_timing(os.path.join(folder, TIMING_FILENAME), [result['timing'] for result in results])
+    #
+    return None
+### ======================================================================== ###
@@ -10,19 +10,66 @@ Handling the plate reader output file
 """
 
 import numpy as np
+import warnings
+from modules.layout import get_layout
 
 
 def calculate_slope(x, y):
     """
     """
-    x = np.array(x)
-    y = np.array(y)
     #
-    xy = x * y
+    return calculate_linear_fit(x, y)[0][0]
+### ======================================================================== ###
+
+def calculate_linear_fit(x, y):
+    """
+    Least squares line fitted to every row of y at once, x is shared by all
+    rows. Returns the slope, intercept and R^2 of each row.
+    """
+    x = np.asarray(x, dtype = np.float64)
+    y = np.atleast_2d(np.asarray(y, dtype = np.float64))
+    #
+    x_mean = x.mean()
+    y_mean = y.mean(axis = 1)
+    dx = x - x_mean
+    dy = y - y_mean[:, np.newaxis]
     #
-    slope = (((len(x) * xy.sum()) - (x.sum()*y.sum())) /
-             ((len(x) * sum(x**2)) - x.sum()**2))
-    return slope
+    sxx = (dx**2).sum()
+    sxy = dy.dot(dx)
+    syy = (dy**2).sum(axis = 1)
+    #
+    slope = sxy / sxx
+    intercept = y_mean - slope * x_mean
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        r_squared = sxy**2 / (sxx * syy)
+    #
+    return slope, intercept, r_squared
+### ======================================================================== ###
+
+def find_time_position(line):
+    """
+    Position of the hh:mm:ss cell of the first row of a timepoint. Exports
+    differ in the number of leading tabs, the temperature and the wells
+    follow the time.
+    """
+    for position, cell in enumerate(line):
+        parts = cell.split(':')
+        if (len(parts) > 1) and all(part.strip().isdigit() for part in parts):
+            return position
+    #
+    raise ValueError('No time (hh:mm:ss) in the first row of the block')
+### ======================================================================== ###
+
+def to_float(text, default):
+    """
+    Convert a cell to float, return the default if it is not a number
+    """
+    try:
+        value = float(text)
+    except ValueError:
+        value = default
+    #
+    return value
 ### ======================================================================== ###
 
 
@@ -31,12 +78,13 @@ def calculate_slope(x, y):
 class Block(object):
     """
     """
-    def __init__(self, lines):
+    def __init__(self, lines, wells = None):
         """
+        lines: the tab separated lines of the block
+        wells: list of well names to keep, all wells are kept if None
         """
-        self.column_names = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
         self._wells = []
-        self.non_exists = 9.9E+99
+        self.non_exists = np.nan
         # -----------------------------
         # Block name is the second value of the first row in the header
         # -----------------------------
@@ -54,14 +102,6 @@ class Block(object):
         # -----------------------------
         self.number_of_points = lines[0][9]
         # -----------------------------
-        # The third row only contains well measurements
-        # -----------------------------
-        self.used_wells = []
-        for index in xrange(2, len(lines[2])):
-            if lines[2][index] != '':
-                self.used_wells.append(index)
-        self.number_of_wells = len(self.used_wells)
-        # -----------------------------
         # Number of columns
         # -----------------------------
         self.number_of_columns = lines[0][18]
@@ -70,9 +110,26 @@ class Block(object):
         # -----------------------------
         self.plate_size = lines[0][19]
         # -----------------------------
-        # How many lines one timepoint recording has
+        # How many lines one timepoint recording has: the second row lists
+        # the column names after the temperature
+        # -----------------------------
+        self.number_of_rows_per_timepoint = self.plate_size / len([name for name in lines[1][2:] if name != ''])
+        # -----------------------------
+        # Every line of a timepoint has the wells at the same positions,
+        # after the time and the temperature of the first line. A column is
+        # used if any of its wells has a value at the first timepoint.
+        # -----------------------------
+        self.time_position = find_time_position(lines[2])
+        first_timepoint = lines[2:2 + self.number_of_rows_per_timepoint]
+        self.used_wells = []
+        for index in xrange(self.time_position + 2, max(len(line) for line in first_timepoint)):
+            if any((index < len(line)) and (line[index] != '') for line in first_timepoint):
+                self.used_wells.append(index)
+        self.number_of_wells = len(self.used_wells)
+        # -----------------------------
+        # Row and column names of the wells
         # -----------------------------
-        self.number_of_rows_per_timepoint = self.plate_size / int(len(lines[1]) - 1)
+        self.set_layout()
         # -----------------------------
         # Storage of time in different timepoints
         # -----------------------------
@@ -82,67 +139,155 @@ class Block(object):
         # -----------------------------
         # Actual data storeage
         # -----------------------------
-        self._raw_value = np.zeros((self.number_of_wells * self.number_of_rows_per_timepoint,
-                              self.number_of_points
-                             ),
-                             dtype = np.float32)
-        self._value = np.zeros((self.number_of_wells * self.number_of_rows_per_timepoint,
-                              self.number_of_points
-                             ),
-                             dtype = np.float32)
-        # -----------------------------
+        time, temperature, values = self.separate_time_point_data(lines, wells)
         #
-        # -----------------------------
-        for point in xrange(self.number_of_points):
-            #
-            time_point_start = 2 + point * (self.number_of_rows_per_timepoint + 1)
-            time_point_end = time_point_start + self.number_of_rows_per_timepoint
-
-            time, temp, value = self.separate_time_point_data(lines[time_point_start:time_point_end],
-                                                              point == 0
-                                                             )
-
-            self.relative_time = time
-            self.temparature = temp
-            self._raw_value[:, point] = value
-            self._value[:, point] = value
+        self._relative_time = time
+        self._absolute_time = np.empty(len(time), dtype = np.float64)
+        self._temperature = temperature
+        self._raw_value = values
+        self._value = values.copy()
         # -----------------------------
         self.find_max()
         self.find_min()
         self.time_shift = 0
         self.slopes = None
-        self.slopes_time = 0
+        self.intercepts = None
+        self.r_squared = None
+        self.slopes_key = None
         #
         return None
     ### ==================================================================== ###
-    def separate_time_point_data(self, lines, first_timepoint):
+    def separate_time_point_data(self, lines, wells = None):
         """
+        Parse all timepoints of the block at once. The cells are collected
+        into a single string matrix and converted to numbers in one step,
+        blank or invalid cells get the non_exists value. Only the listed
+        wells are converted if wells is given.
         """
-        time_point = 0
-        temperature = 0
-        values = []
-        for i in xrange(len(lines)):
-            if i == 0:
-                time_point = self.time2sec(lines[i][0])
-                temperature = float(lines[i][1])
-            for well in xrange(self.number_of_wells):
-                if i == 0:
-                    position = self.used_wells[well]
+        rows = self.number_of_rows_per_timepoint
+        # -----------------------------
+        # First row of each timepoint holds the time and the temperature
+        # -----------------------------
+        first_rows = lines[2::rows + 1][:self.number_of_points]
+        time = [self.time2sec(line[self.time_position]) for line in first_rows]
+        temperature = [float(line[self.time_position + 1]) for line in first_rows]
+        # -----------------------------
+        # Well names from the first timepoint
+        # -----------------------------
+        # Columns of the wells start after the temperature
+        self._wells = self.layout.well_name(np.repeat(np.arange(rows), self.number_of_wells),
+                                            np.tile(np.array(self.used_wells) - self.time_position - 2,
+                                                    rows)).tolist()
+        # -----------------------------
+        # Collect the cells of the used columns, every row from the same
+        # positions. Missing ones at the end of a line are blank.
+        # -----------------------------
+        first = self.used_wells[0]
+        last = self.used_wells[-1] + 1
+        contiguous = self.used_wells == range(first, last)
+        blank = [''] * last
+        cells = []
+        for point in xrange(self.number_of_points):
+            start = 2 + point * (rows + 1)
+            for line in lines[start:start + rows]:
+                if len(line) < last:
+                    line = line + blank
+                if contiguous:
+                    cells.append(line[first:last])
                 else:
-                    position = well#self.used_wells[well] - 2
-
-                if first_timepoint:
-#                    self.wells = self.column_names[i] + str(well+1)
-                    self.wells = self.column_names[i] + str(self.used_wells[well] - 1)
-                #
-                try:
-                    values.append(float(lines[i][position]))
-                except IndexError:
-                    values.append(self.non_exists)
-                except ValueError:
-                    values.append(self.non_exists)
+                    cells.append([line[position] for position in self.used_wells])
+        cells = np.array(cells).reshape(self.number_of_points, -1)
+        # -----------------------------
+        # Keep the selected wells only
+        # -----------------------------
+        if wells is not None:
+            wells = set(wells)
+            selected = [i for i, name in enumerate(self.wells) if name in wells]
+            self._wells = [self.wells[i] for i in selected]
+            cells = cells[:, selected]
+        # -----------------------------
+        # Convert the numbers
+        # -----------------------------
+        values = np.empty(cells.shape, dtype = np.float32)
+        values.fill(self.non_exists)
+        filled = cells != ''
+        try:
+            values[filled] = cells[filled].astype(np.float32)
+        except ValueError:
+            # Some cells are not numbers, convert them one by one
+            values[filled] = [to_float(cell, self.non_exists) for cell in cells[filled]]
+        # -----------------------------
+        # One column for each timepoint
+        # -----------------------------
+        values = np.ascontiguousarray(values.T)
+        #
+        return time, temperature, values
+    ### ==================================================================== ###
+    def set_layout(self):
+        """
+        Plate layout from the number of rows of a timepoint and the columns
+        """
+        columns = max([self.number_of_columns] +
+                      [position - self.time_position - 1 for position in self.used_wells])
+        self.layout = get_layout(self.number_of_rows_per_timepoint, columns)
+        #
+        return None
+    ### ==================================================================== ###
+    def get_state(self):
+        """
+        Header information and arrays of the block to store it in the cache
+        """
+        info = {'block_name' : self.block_name,
+                'file_format' : self.file_format,
+                'measurement_type' : self.measurement_type,
+                'number_of_points' : self.number_of_points,
+                'time_position' : self.time_position,
+                'used_wells' : self.used_wells,
+                'number_of_wells' : self.number_of_wells,
+                'number_of_columns' : self.number_of_columns,
+                'plate_size' : self.plate_size,
+                'number_of_rows_per_timepoint' : self.number_of_rows_per_timepoint,
+                'wells' : self.wells,
+               }
+        arrays = {'raw_value' : self._raw_value,
+                  'value' : self._value,
+                  'max' : self._max,
+                  'min' : self._min,
+                  'relative_time' : np.array(self._relative_time),
+                  'temperature' : np.array(self._temperature),
+                 }
+        #
+        return info, arrays
+    ### ==================================================================== ###
+    @classmethod
+    def from_state(cls, info, arrays):
+        """
+        Rebuild a block stored by get_state without parsing the text again
+        """
+        block = cls.__new__(cls)
+        block.non_exists = np.nan
+        #
+        for name in info:
+            if name != 'wells':
+                setattr(block, name, info[name])
+        block._wells = list(info['wells'])
+        block.set_layout()
+        #
+        block._raw_value = arrays['raw_value']
+        block._value = arrays['value']
+        block._max = arrays['max']
+        block._min = arrays['min']
+        block._relative_time = arrays['relative_time'].tolist()
+        block._absolute_time = np.empty(len(block._relative_time), dtype = np.float64)
+        block._temperature = arrays['temperature'].tolist()
         #
-        return time_point, temperature, np.array(values, dtype = np.float32)
+        block.time_shift = 0
+        block.slopes = None
+        block.intercepts = None
+        block.r_squared = None
+        block.slopes_key = None
+        #
+        return block
     ### ==================================================================== ###
     def time2sec(self, time_string):
         """
@@ -152,11 +297,11 @@ class Block(object):
     ### ========================================================================
     def normalize(self, values):
         """
+        Divide every well by its own value, wells without value become NaN
         """
-        for i in xrange(len(values)):
-            if values[i] < self.non_exists:
-                self._value[i, :] /= values[i]
+        values = np.asarray(values, dtype = np.float32)
         #
+        self._value /= values[:, np.newaxis]
         self._max /= values
         self._min /= values
         #
@@ -165,22 +310,20 @@ class Block(object):
     def find_max(self):
         """
         """
-        self._max = np.empty(self._raw_value.shape[0], dtype = np.float32)
-        for i in xrange(self._raw_value.shape[0]):
-            value = self.value[i]
-            mask = value < self.non_exists * 0.1
-            self._max[i] = value[mask].max()
+        with warnings.catch_warnings():
+            # Wells without any data give NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            self._max = np.nanmax(self.value, axis = 1)
         #
         return None
     ### ========================================================================
     def find_min(self):
         """
         """
-        self._min = np.empty(self._raw_value.shape[0], dtype = np.float32)
-        for i in xrange(self._raw_value.shape[0]):
-            value = self.value[i]
-            mask = value < self.non_exists * 0.1
-            self._min[i] = value[mask].min()
+        with warnings.catch_warnings():
+            # Wells without any data give NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            self._min = np.nanmin(self.value, axis = 1)
         #
         return None
     ### ========================================================================
@@ -193,10 +336,26 @@ class Block(object):
         """
         """
         self._timeshift = float(shift)
+        # In place, the time may be a view of the plate time vector
+        self._absolute_time[:] = self.relative_time
+        self._absolute_time += self._timeshift
         #
-        self._absolute_time = []
-        for timepoint in self.relative_time:
-            self._absolute_time.append(timepoint + shift)
+        return None
+    ### ========================================================================
+    def use_storage(self, raw_value, value, time, copy = True):
+        """
+        Keep the data in the given arrays from now on, usually views of the
+        contiguous plate arrays of the measurement. The current values are
+        copied into them unless copy is False (they are already there).
+        """
+        if copy:
+            raw_value[...] = self._raw_value
+            value[...] = self._value
+        time[...] = self._absolute_time
+        #
+        self._raw_value = raw_value
+        self._value = value
+        self._absolute_time = time
         #
         return None
     ### ========================================================================
@@ -222,7 +381,7 @@ class Block(object):
         return self._block_name
     @block_name.setter
     def block_name(self, name):
-        self._block_name = str(name).lower()
+        self._block_name = unicode(name).lower()
         return None
     ### ==================================================================== ###
     @property
@@ -362,24 +521,32 @@ class Block(object):
     ### ==================================================================== ###
     def slope(self, previous_block_last_elements, number_of_points_to_use = 5, time_addition_takes = 30):
         """
+        Start slope of every well: a line fitted to the last point of the
+        previous block and the first points of this block. The intercepts and
+        R^2 values are also kept.
         """
-        if self.slopes_time != time_addition_takes:
+        key = (time_addition_takes, number_of_points_to_use)
+        if self.slopes_key != key:
             #
             number_of_points_to_use -= 1
             if self.value.shape[1] <= number_of_points_to_use:
                 number_of_points_to_use = self.value.shape[1]
             #
-            time = np.array([0] + [time_addition_takes + timepoint for timepoint in self._relative_time[:number_of_points_to_use]], dtype = np.float32)
+            time = np.empty(1 + number_of_points_to_use, dtype = np.float32)
+            time[0] = 0
+            time[1:] = self._relative_time[:number_of_points_to_use]
+            time[1:] += time_addition_takes
             #
             data = np.empty((self.value.shape[0], 1 + number_of_points_to_use), dtype = np.float32)
             data[:, 0] = previous_block_last_elements
             data[:, 1:] = self.value[:, :number_of_points_to_use]
-
-            self.slopes = np.empty(data.shape[0], dtype = np.float32)
-            for i in xrange(data.shape[0]):
-                self.slopes[i] = calculate_slope(time, data[i,:])
             #
-            self.slopes_time = time_addition_takes
+            slopes, intercepts, r_squared = calculate_linear_fit(time, data)
+            self.slopes = slopes.astype(np.float32)
+            self.intercepts = intercepts.astype(np.float32)
+            self.r_squared = r_squared.astype(np.float32)
+            #
+            self.slopes_key = key
         #
         return self.slopes
     ### ==================================================================== ###
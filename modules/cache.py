@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Under GPL licence.
+
+Purpose:
+========
+Binary cache of the parsed plates. Each measurement file gets a folder with
+the plate arrays (memory mapped on reload), the small arrays of its blocks and
+a manifest with the block headers and the fingerprint of the source file.
+
+Figure cache: a manifest in the figure folder with the hash of the inputs of
+each figure, so unchanged figures are not rendered again.
+
+"""
+
+import errno
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import time
+from modules.block import Block
+
+
+# Change it whenever the stored content changes
+CACHE_VERSION = 5
+# Block arrays which are stored as part of the plate arrays
+PLATE_ARRAYS = ('raw_value', 'value')
+# Entries are written into temporary folders with this prefix
+TEMPORARY_PREFIX = 'writing_'
+# Temporary folders older than this (sec) were left by a failed process
+TEMPORARY_TIMEOUT = 24 * 3600
+# Manifest of the figure folders
+FIGURE_MANIFEST = 'figures.json'
+# Change it whenever the content of the figure manifest changes
+FIGURE_CACHE_VERSION = 1
+
+
+def file_hash(filename, chunk_size = 2**20):
+    """
+    SHA1 of the file content
+    """
+    content_hash = hashlib.sha1()
+    with open(filename, 'rb') as datafile:
+        chunk = datafile.read(chunk_size)
+        while chunk:
+            content_hash.update(chunk)
+            chunk = datafile.read(chunk_size)
+    #
+    return content_hash.hexdigest()
+### ======================================================================== ###
+
+def data_hash(value, content_hash = None):
+    """
+    SHA1 of nested dicts, lists, numpy arrays, strings and numbers. The keys
+    of the dicts are sorted, so the insertion order does not matter.
+    """
+    digest = content_hash is None
+    if digest:
+        content_hash = hashlib.sha1()
+    #
+    if isinstance(value, dict):
+        content_hash.update('dict' + str(len(value)))
+        for key in sorted(value):
+            data_hash(key, content_hash)
+            data_hash(value[key], content_hash)
+    elif isinstance(value, (list, tuple)):
+        content_hash.update('list' + str(len(value)))
+        for item in value:
+            data_hash(item, content_hash)
+    elif isinstance(value, (np.ndarray, np.generic)):
+        value = np.ascontiguousarray(value)
+        content_hash.update(''.join(('array', value.dtype.str, str(value.shape))))
+        # The buffer of the array, without a copy
+        content_hash.update(value)
+    elif isinstance(value, unicode):
+        content_hash.update('unicode' + value.encode('utf-8'))
+    else:
+        content_hash.update(type(value).__name__ + repr(value))
+    #
+    if digest:
+        return content_hash.hexdigest()
+    return None
+### ======================================================================== ###
+
+def folder_size(folder):
+    """
+    Total size of the files in the folder in bytes
+    """
+    size = 0
+    for path, _, filenames in os.walk(folder):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(path, filename))
+    #
+    return size
+### ======================================================================== ###
+
+
+
+
+class PlateCache(object):
+    """
+    """
+    def __init__(self, folder = None, size_limit = 2 * 2**30):
+        """
+        folder: the cache folder, '~/.plate_reader_cache' by default
+        size_limit: the oldest entries are removed above this size (bytes)
+        """
+        if folder is None:
+            folder = os.path.join(os.path.expanduser('~'), '.plate_reader_cache')
+        self.folder = folder
+        self.size_limit = size_limit
+        #
+        return None
+    ### ==================================================================== ###
+    def entry_folder(self, datafilename):
+        """
+        Each measurement file has its own folder named by its path
+        """
+        path = os.path.abspath(datafilename)
+        # Byte string paths are hashed as they are
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        name = hashlib.sha1(path).hexdigest()
+        #
+        return os.path.join(self.folder, name)
+    ### ==================================================================== ###
+    def read_manifest(self, entry):
+        """
+        """
+        try:
+            with open(os.path.join(entry, 'manifest.json'), 'r') as manifestfile:
+                manifest = json.load(manifestfile)
+        except (IOError, ValueError):
+            manifest = None
+        #
+        return manifest
+    ### ==================================================================== ###
+    def is_valid(self, manifest, entry, datafilename):
+        """
+        Size and modification time are checked first, the content hash is only
+        calculated when those differ (e.g. the file was copied or touched)
+        """
+        if manifest.get('version') != CACHE_VERSION:
+            return False
+        #
+        size = os.path.getsize(datafilename)
+        mtime = os.path.getmtime(datafilename)
+        if size != manifest['size']:
+            return False
+        if mtime == manifest['mtime']:
+            return True
+        # ------------------------
+        # Same content with a new time stamp
+        # ------------------------
+        if file_hash(datafilename) != manifest['hash']:
+            return False
+        manifest['mtime'] = mtime
+        self.write_manifest(entry, manifest)
+        #
+        return True
+    ### ==================================================================== ###
+    def write_manifest(self, entry, manifest):
+        """
+        """
+        with open(os.path.join(entry, 'manifest.json'), 'w') as manifestfile:
+            json.dump(manifest, manifestfile)
+        #
+        return None
+    ### ==================================================================== ###
+    def load(self, datafilename):
+        """
+        Returns the list of (position in the file, Block) pairs and the plate
+        raw_values and values arrays, or None if the file is not in the cache
+        or it has changed since it was stored
+        """
+        entry = self.entry_folder(datafilename)
+        manifest = self.read_manifest(entry)
+        if manifest is None:
+            return None
+        # ------------------------
+        # An outdated entry, or one with a missing or damaged file, is
+        # removed and the plate is parsed again
+        # ------------------------
+        try:
+            loaded = None
+            if self.is_valid(manifest, entry, datafilename):
+                loaded = self.load_entry(entry, manifest)
+        except (IOError, ValueError, KeyError):
+            loaded = None
+        if loaded is None:
+            shutil.rmtree(entry, ignore_errors = True)
+            return None
+        # ------------------------
+        # Last use time for the eviction
+        # ------------------------
+        try:
+            os.utime(os.path.join(entry, 'manifest.json'), None)
+        except (IOError, OSError):
+            pass
+        #
+        return loaded
+    ### ==================================================================== ###
+    def load_entry(self, entry, manifest):
+        """
+        Blocks and plate arrays of a valid entry
+        """
+        # ------------------------
+        # Plate arrays are memory mapped
+        # ------------------------
+        raw_values = np.load(os.path.join(entry, 'raw_values.npy'), mmap_mode = 'r')
+        values = np.load(os.path.join(entry, 'values.npy'), mmap_mode = 'r')
+        # ------------------------
+        # Rebuild the blocks on views of the plate arrays
+        # ------------------------
+        blocks = []
+        for block, block_info in enumerate(manifest['blocks']):
+            start, end = block_info['columns']
+            arrays = {'raw_value' : raw_values[:, start:end],
+                      'value' : values[:, start:end],
+                     }
+            for name in block_info['arrays']:
+                arrays[name] = np.load(os.path.join(entry, ''.join(('block_', str(block), '_', name, '.npy'))))
+            blocks.append((block_info['position'], Block.from_state(block_info['info'], arrays)))
+        #
+        return blocks, raw_values, values
+    ### ==================================================================== ###
+    def store(self, datafilename, blocks, raw_values, values, block_offsets):
+        """
+        Store the list of (position in the file, Block) pairs, the plate
+        arrays and the first column of each block in the plate arrays.
+        Returns False if the entry could not be written (e.g. the cache
+        folder is not writable), the plate itself is not affected.
+        """
+        try:
+            self.write_entry(datafilename, blocks, raw_values, values, block_offsets)
+        except (IOError, OSError) as error:
+            print 'The plate is not cached:', error
+            return False
+        #
+        return True
+    ### ==================================================================== ###
+    def write_entry(self, datafilename, blocks, raw_values, values, block_offsets):
+        """
+        """
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                # Made by another process in the meantime
+                if not os.path.isdir(self.folder):
+                    raise
+        # ------------------------
+        # Write into a temporary folder, so a broken entry is never visible
+        # ------------------------
+        temporary = tempfile.mkdtemp(prefix = TEMPORARY_PREFIX, dir = self.folder)
+        try:
+            self.write_arrays(temporary, datafilename, blocks, raw_values, values, block_offsets)
+        except:
+            shutil.rmtree(temporary, ignore_errors = True)
+            raise
+        # ------------------------
+        # Replace the previous entry. Another process storing the same file
+        # may put its entry there first, that one is as good as this one.
+        # ------------------------
+        entry = self.entry_folder(datafilename)
+        shutil.rmtree(entry, ignore_errors = True)
+        try:
+            os.rename(temporary, entry)
+        except OSError as error:
+            shutil.rmtree(temporary, ignore_errors = True)
+            if error.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        #
+        self.evict(keep = entry)
+        #
+        return None
+    ### ==================================================================== ###
+    def write_arrays(self, temporary, datafilename, blocks, raw_values, values, block_offsets):
+        """
+        Arrays and manifest of an entry
+        """
+        source = os.path.abspath(datafilename)
+        if not isinstance(source, unicode):
+            source = source.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+        manifest = {'version' : CACHE_VERSION,
+                    'source' : source,
+                    'size' : os.path.getsize(datafilename),
+                    'mtime' : os.path.getmtime(datafilename),
+                    'hash' : file_hash(datafilename),
+                    'blocks' : [],
+                   }
+        np.save(os.path.join(temporary, 'raw_values.npy'), raw_values)
+        np.save(os.path.join(temporary, 'values.npy'), values)
+        #
+        for block, (position, data) in enumerate(blocks):
+            info, arrays = data.get_state()
+            for name in PLATE_ARRAYS:
+                del arrays[name]
+            for name in arrays:
+                np.save(os.path.join(temporary, ''.join(('block_', str(block), '_', name, '.npy'))),
+                        arrays[name])
+            manifest['blocks'].append({'position' : position,
+                                       'info' : info,
+                                       'arrays' : sorted(arrays),
+                                       'columns' : [int(block_offsets[block]),
+                                                    int(block_offsets[block + 1])],
+                                      })
+        self.write_manifest(temporary, manifest)
+        #
+        return None
+    ### ==================================================================== ###
+    def evict(self, keep = None):
+        """
+        Remove the least recently used entries until the cache fits in the
+        size limit. The keep entry and the entries being written by other
+        processes are never removed.
+        """
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.folder):
+            entry = os.path.join(self.folder, name)
+            if not os.path.isdir(entry):
+                continue
+            # Other processes may remove or rename the folder meanwhile
+            try:
+                if name.startswith(TEMPORARY_PREFIX):
+                    # Left behind by a process which stopped while writing
+                    if time.time() - os.path.getmtime(entry) > TEMPORARY_TIMEOUT:
+                        shutil.rmtree(entry, ignore_errors = True)
+                    continue
+                manifest_filename = os.path.join(entry, 'manifest.json')
+                if os.path.isfile(manifest_filename):
+                    last_used = os.path.getmtime(manifest_filename)
+                else:
+                    last_used = 0
+                size = folder_size(entry)
+            except OSError:
+                continue
+            entries.append((last_used, size, entry))
+            total_size += size
+        # ------------------------
+        # Oldest first
+        # ------------------------
+        entries.sort()
+        for last_used, size, entry in entries:
+            if total_size <= self.size_limit:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors = True)
+            total_size -= size
+        #
+        return None
+    ### ==================================================================== ###
+    def clear(self):
+        """
+        Remove every entry
+        """
+        shutil.rmtree(self.folder, ignore_errors = True)
+        #
+        return None
+    ### ==================================================================== ###
+    ### ==================================================================== ###
+    ### ==================================================================== ###
+
+
+
+
+class FigureCache(object):
+    """
+    Manifest of a figure folder: for each figure the hash of its inputs and
+    the files it was saved into
+    """
+    def __init__(self, folder):
+        """
+        """
+        self.folder = folder
+        self.figures = {}
+        try:
+            with open(os.path.join(folder, FIGURE_MANIFEST), 'r') as manifestfile:
+                manifest = json.load(manifestfile)
+            if manifest.get('version') == FIGURE_CACHE_VERSION:
+                self.figures = manifest['figures']
+        except (IOError, ValueError, KeyError):
+            pass
+        #
+        return None
+    ### ==================================================================== ###
+    def is_current(self, key, input_hash):
+        """
+        The figure was made from the same inputs and its files still exist
+        """
+        entry = self.figures.get(key)
+        if (entry is None) or (entry['hash'] != input_hash):
+            return False
+        #
+        return all(os.path.isfile(os.path.join(self.folder, name)) for name in entry['files'])
+    ### ==================================================================== ###
+    def update(self, key, input_hash, filenames):
+        """
+        """
+        self.figures[key] = {'hash' : input_hash,
+                             'files' : [os.path.basename(name) for name in filenames],
+                            }
+        #
+        return None
+    ### ==================================================================== ###
+    def save(self):
+        """
+        """
+        with open(os.path.join(self.folder, FIGURE_MANIFEST), 'w') as manifestfile:
+            json.dump({'version' : FIGURE_CACHE_VERSION, 'figures' : self.figures}, manifestfile,
+                      indent = 1, sort_keys = True)
+        #
+        return None
+    ### ==================================================================== ###
+    ### ==================================================================== ###
+    ### ==================================================================== ###
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Under GPL licence.
+
+Purpose:
+========
+Command line (headless) processing of plates: load -> labels -> statistics
+-> save -> plots, without the wx front end. matplotlib and h5py are only
+imported when figures or HDF5 files are made.
+
+Example:
+    python kinetic_measurements.py plate1.xls plate2.xls -l labels.xls -t 30
+
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import cpu_count
+from modules.measurement import Measurement
+from modules.cache import PlateCache
+from modules.excel import XLSX_AVAILABLE
+
+
+# Output file extensions
+OUTPUT_FORMATS = {'xls' : '.xls',
+                  'xlsx' : '.xlsx',
+                  'hdf5' : '.h5',
+                 }
+
+
+def build_parser():
+    """
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Convert kinetic plate reader measurements and plot the results')
+    parser.add_argument('datafiles', nargs = '*', metavar = 'DATAFILE',
+                        help = 'plate reader file(s) in plate format')
+    parser.add_argument('-l', '--label', action = 'append', metavar = 'LABELFILE',
+                        help = 'label file, once for all plates or once for each plate')
+    parser.add_argument('-m', '--manifest', default = None,
+                        help = 'csv file of the plates: datafile,labelfile,addition_time')
+    parser.add_argument('-t', '--addition-time', type = int, default = 30,
+                        help = 'time of an addition in seconds (default: 30)')
+    parser.add_argument('-s', '--sigma', type = float, default = 1.5,
+                        help = 'outlier filter limit in standard deviations (default: 1.5)')
+    parser.add_argument('-o', '--output-folder', default = None,
+                        help = 'folder of the results (default: next to the data file)')
+    parser.add_argument('-f', '--format', action = 'append', choices = sorted(OUTPUT_FORMATS),
+                        help = 'output format(s) (default: xlsx if available, otherwise xls)')
+    parser.add_argument('--no-save', action = 'store_true',
+                        help = 'do not write the converted data')
+    parser.add_argument('--no-plot', action = 'store_true',
+                        help = 'do not plot the figures')
+    parser.add_argument('-p', '--profile', choices = ('publication', 'preview'), default = 'publication',
+                        help = 'render profile of the figures (default: publication)')
+    parser.add_argument('-w', '--workers', type = int, default = cpu_count(),
+                        help = 'number of processes reading the blocks, or the plates of a manifest')
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'do not use the cache of parsed plates')
+    parser.add_argument('--timing', default = None, metavar = 'JSONFILE',
+                        help = 'print the time and memory of the stages and save them into a json file')
+    parser.add_argument('--cprofile', default = None, metavar = 'STAGE',
+                        help = 'save the cProfile statistics of a stage (e.g. calculate_mean_curve) '
+                               'into <plate name>_analyzed_<stage>.prof, every run of a per block '
+                               'stage (e.g. parse_block) is added')
+    #
+    return parser
+### ======================================================================== ###
+
+def plate_name(datafilename):
+    """
+    Name of the plate from the data file name
+    """
+    return os.path.splitext(os.path.basename(datafilename))[0]
+### ======================================================================== ###
+
+def output_folder_of(datafilename, output_folder):
+    """
+    The output folder, or the folder of the data file if it is None
+    """
+    if output_folder is None:
+        output_folder = os.path.dirname(os.path.abspath(datafilename))
+    #
+    return output_folder
+### ======================================================================== ###
+
+def output_filename(datafilename, output_folder, extension, name = None):
+    """
+    <output folder>/<plate name>_analyzed<extension>, name is the plate name
+    (the data file name if None)
+    """
+    if name is None:
+        name = plate_name(datafilename)
+    #
+    return os.path.join(output_folder_of(datafilename, output_folder), name + '_analyzed' + extension)
+### ======================================================================== ###
+
+def output_names(datafilenames, output_folder):
+    """
+    Plate name of each data file for its output files. Plates which would
+    write the same files (the same name in the same folder, e.g. a data file
+    listed twice) get their number in the list after the name.
+    """
+    targets = [(os.path.abspath(output_folder_of(datafilename, output_folder)), plate_name(datafilename))
+               for datafilename in datafilenames]
+    taken = set(targets)
+    names = []
+    for number, (folder, name) in enumerate(targets, 1):
+        if targets.count((folder, name)) > 1:
+            unique_name = name + '_' + str(number)
+            while (folder, unique_name) in taken:
+                unique_name += '_' + str(number)
+            taken.add((folder, unique_name))
+            name = unique_name
+        names.append(name)
+    #
+    return names
+### ======================================================================== ###
+
+def process_plate(datafilename, label_filename, options, name = None):
+    """
+    The whole pipeline of one plate, returns the Measurement and the list of
+    the written files. name: plate name of the output files, the data file
+    name if None.
+    """
+    if name is None:
+        name = plate_name(datafilename)
+    measurement = Measurement()
+    measurement.sigma = options.sigma
+    measurement.workers = options.workers
+    if not options.no_cache:
+        measurement.cache = PlateCache()
+    if options.cprofile is not None:
+        measurement.profiler.profile_stage = options.cprofile
+        measurement.profiler.profile_filename = output_filename(datafilename, options.output_folder,
+                                                                '_' + options.cprofile + '.prof', name)
+    #
+    measurement.read_measurement_datafile(datafilename)
+    measurement.read_label_datafile(label_filename, options.addition_time)
+    # ---------------------------
+    # Converted data
+    # ---------------------------
+    written = []
+    if not options.no_save:
+        for output_format in options.format:
+            filename = output_filename(datafilename, options.output_folder,
+                                       OUTPUT_FORMATS[output_format], name)
+            if output_format == 'hdf5':
+                measurement.save_columnar_file(filename)
+            else:
+                measurement.save_datafile(filename)
+            written.append(filename)
+    # ---------------------------
+    # Figures
+    # ---------------------------
+    if not options.no_plot:
+        folder_name = output_folder_of(datafilename, options.output_folder)
+        measurement.plot_data(name, folder_name, options.profile)
+        written.append(os.path.join(folder_name, name.replace(' ', '_') + '_figures'))
+    #
+    return measurement, written
+### ======================================================================== ###
+
+def timing_entry(datafilename, label_filename, name, records):
+    """
+    Stage records of one plate for the timing file
+    """
+    return {'datafile' : datafilename,
+            'labelfile' : label_filename,
+            'name' : name,
+            'stages' : records,
+           }
+### ======================================================================== ###
+
+def save_timing(filename, timing):
+    """
+    List of the timing entries of the plates, in the order of the plates
+    """
+    with open(filename, 'w') as jsonfile:
+        json.dump(timing, jsonfile, indent = 1, sort_keys = True)
+    #
+    return None
+### ======================================================================== ###
+
+def main(arguments = None):
+    """
+    Returns the exit status
+    """
+    parser = build_parser()
+    options = parser.parse_args(arguments)
+    if options.format is None:
+        options.format = ['xlsx' if XLSX_AVAILABLE else 'xls']
+    if (options.output_folder is not None) and (not os.path.isdir(options.output_folder)):
+        os.makedirs(options.output_folder)
+    # ---------------------------
+    # Plates of a manifest in parallel
+    # ---------------------------
+    if options.manifest is not None:
+        if options.datafiles or options.label:
+            parser.error('give either a manifest or data and label files')
+        from modules.batch import read_manifest
+        from modules.batch import run_batch
+        jobs = read_manifest(options.manifest, options.addition_time)
+        summary_folder = options.output_folder
+        if summary_folder is None:
+            summary_folder = os.path.dirname(os.path.abspath(options.manifest))
+        results = run_batch(jobs, options, options.workers, summary_folder)
+        if options.timing is not None:
+            save_timing(options.timing, [result['timing'] for result in results])
+        #
+        return int(any(result['status'] != 'ok' for result in results))
+    # ---------------------------
+    # One label file for every plate or one for each
+    # ---------------------------
+    if not options.datafiles or not options.label:
+        parser.error('give the data files and the label file(s), or a manifest')
+    if len(options.label) == 1:
+        label_filenames = options.label * len(options.datafiles)
+    elif len(options.label) == len(options.datafiles):
+        label_filenames = options.label
+    else:
+        parser.error('give one label file, or one for each data file')
+    # ---------------------------
+    # Plates one after the other
+    # ---------------------------
+    timing = []
+    names = output_names(options.datafiles, options.output_folder)
+    for datafilename, label_filename, name in zip(options.datafiles, label_filenames, names):
+        start = time.time()
+        print 'Plate:', datafilename
+        measurement, _ = process_plate(datafilename, label_filename, options, name)
+        print 'Done in', round(time.time() - start, 1), 'sec'
+        if options.timing is not None:
+            print measurement.profiler.report()
+            timing.append(timing_entry(datafilename, label_filename, name, measurement.profiler.records))
+    #
+    if options.timing is not None:
+        save_timing(options.timing, timing)
+    #
+    return 0
+### ======================================================================== ###
+
+if __name__ == "__main__":
+    sys.exit(main())
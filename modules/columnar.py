@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Under GPL licence.
+
+Purpose:
+========
+Columnar (HDF5) export of a measurement: traces as wells x time matrices,
+per well metadata and per group statistics in compressed, chunked datasets.
+Many plates can be queried without opening the workbooks.
+
+Layout of the file:
+    traces/raw, traces/normalized    wells x timepoints
+    traces/time, traces/block_offsets
+    blocks/names, blocks/positions
+    wells/names, wells/labels        labels: wells x label sheets
+    statistics/baseline/...          group_names, mean, std, len
+    statistics/response/block_N/...
+    statistics/slope/block_N/...
+    statistics/mean_curve/block_N/... mean, std, len: groups x timepoints
+
+N is the number of the block from 1, the same as in the figure names
+(response_2, block_3, ...), the block_name attribute of the group is the
+name used in the workbook sheets. The source and label_file attributes of the
+file are the input file names (bytes if the file system encoding can not
+decode them).
+
+"""
+
+import numpy as np
+import sys
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+# Columnar output needs the h5py package
+HDF5_AVAILABLE = h5py is not None
+# Change it whenever the layout changes
+FORMAT_VERSION = 2
+
+
+def path_text(path):
+    """
+    File name for an attribute: byte string paths are decoded with the file
+    system encoding, or stored as bytes if they can not be decoded
+    """
+    if isinstance(path, unicode):
+        return path
+    #
+    try:
+        return str(path).decode(sys.getfilesystemencoding() or 'utf-8')
+    except UnicodeDecodeError:
+        return str(path)
+### ======================================================================== ###
+
+def string_dataset(group, name, values):
+    """
+    Variable length unicode strings
+    """
+    values = np.array([unicode(value) for value in np.ravel(values)], dtype = object).reshape(np.shape(values))
+    group.create_dataset(name, data = values, dtype = h5py.special_dtype(vlen = unicode))
+    #
+    return None
+### ======================================================================== ###
+
+def matrix_dataset(group, name, values, chunk_rows = 64, chunk_columns = 1024):
+    """
+    Compressed, chunked 2D dataset
+    """
+    values = np.asarray(values)
+    chunks = (max(1, min(values.shape[0], chunk_rows)), max(1, min(values.shape[1], chunk_columns)))
+    group.create_dataset(name, data = values, chunks = chunks,
+                         compression = 'gzip', compression_opts = 4, shuffle = True)
+    #
+    return None
+### ======================================================================== ###
+
+def statistics_group(group, name, statistics):
+    """
+    One entry for each group: name, mean, std and number of data
+    """
+    subgroup = group.create_group(name)
+    names = sorted(statistics)
+    string_dataset(subgroup, 'group_names', names)
+    for key in ('mean', 'std', 'len'):
+        values = np.array([statistics[group_name][key] for group_name in names])
+        if values.ndim == 2 and values.shape[1] == 1:
+            values = values[:, 0]
+        if values.ndim == 2:
+            matrix_dataset(subgroup, key, values)
+        else:
+            subgroup.create_dataset(key, data = values)
+    #
+    return None
+### ======================================================================== ###
+
+def save_hdf5(measurement, filename):
+    """
+    Write the traces, well information and group statistics of a measurement
+    (labels and statistics have to be calculated already)
+    """
+    if h5py is None:
+        raise ImportError('The h5py package is needed to write HDF5 files')
+    #
+    label = measurement.label
+    # Only the loaded wells if some wells were selected
+    well_names, label_wells, rows = measurement.labelled_wells()
+    #
+    with h5py.File(filename, 'w') as datafile:
+        datafile.attrs['format_version'] = FORMAT_VERSION
+        datafile.attrs['source'] = path_text(measurement._datafilename)
+        datafile.attrs['label_file'] = path_text(measurement.label_filename)
+        datafile.attrs['sigma'] = measurement.sigma
+        datafile.attrs['number_of_blocks'] = measurement.number_of_blocks
+        # ---------------------------
+        # Traces
+        # ---------------------------
+        traces = datafile.create_group('traces')
+        matrix_dataset(traces, 'raw', measurement.raw_values[rows])
+        matrix_dataset(traces, 'normalized', measurement.values[rows])
+        traces.create_dataset('time', data = measurement.time)
+        traces.create_dataset('block_offsets', data = measurement.block_offsets)
+        # ---------------------------
+        # Blocks
+        # ---------------------------
+        blocks = datafile.create_group('blocks')
+        string_dataset(blocks, 'names', [measurement.data[block].block_name
+                                         for block in xrange(measurement.number_of_blocks)])
+        blocks.create_dataset('positions', data = np.array(measurement.block_indices))
+        # ---------------------------
+        # Wells and their labels on each sheet
+        # ---------------------------
+        wells = datafile.create_group('wells')
+        string_dataset(wells, 'names', well_names)
+        label_codes = label.label_codes[label_wells]
+        labels = np.empty(label_codes.shape, dtype = object)
+        for sheet in xrange(label_codes.shape[1]):
+            labels[:, sheet] = np.array(label.sheet_labels[sheet], dtype = object)[label_codes[:, sheet]]
+        string_dataset(wells, 'labels', labels)
+        # ---------------------------
+        # Group statistics
+        # ---------------------------
+        statistics = datafile.create_group('statistics')
+        statistics_group(statistics, 'baseline', measurement.baseline)
+        for name, values in (('response', measurement.response),
+                             ('slope', measurement.start_slope),
+                             ('mean_curve', measurement.mean_curve)):
+            group = statistics.create_group(name)
+            for block in values:
+                block_group = 'block_' + str(block + 1)
+                statistics_group(group, block_group, values[block])
+                group[block_group].attrs['block_name'] = measurement.data[block].block_name
+    #
+    return None
+### ======================================================================== ###
+
+def read_group_statistics(filenames, statistic = 'response', block = None):
+    """
+    Generator of (filename, block, group name, mean, std, len) records of the
+    group statistics of many plates, only the small statistics datasets are
+    read. statistic: 'baseline', 'response' or 'slope'
+    block: number of the block from 1 (as in the file), all blocks if None
+    """
+    if h5py is None:
+        raise ImportError('The h5py package is needed to read HDF5 files')
+    #
+    for filename in filenames:
+        with h5py.File(filename, 'r') as datafile:
+            if statistic == 'baseline':
+                groups = [(None, datafile['statistics/baseline'])]
+            else:
+                groups = [(int(name.split('_')[-1]), group)
+                          for name, group in datafile['statistics'][statistic].items()]
+            #
+            for block_index, group in sorted(groups):
+                if (block is not None) and (block_index != block):
+                    continue
+                for index, name in enumerate(group['group_names'][...]):
+                    yield (filename, block_index, name,
+                           group['mean'][index], group['std'][index], group['len'][index])
+### ======================================================================== ###
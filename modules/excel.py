@@ -5,7 +5,117 @@ Created by Zoltan Bozoky on 2015.04.12.
 Under GPL licence.
 """
 
+import numpy as np
+import re
 import xlwt
+from bisect import bisect_right
+from itertools import izip_longest
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+
+# .xlsx output needs the xlsxwriter package
+XLSX_AVAILABLE = xlsxwriter is not None
+
+
+def write_number_or_blank(sheet, row, column, value, cell_format = None):
+    """
+    xlsxwriter handler of the float and numpy number cells, NaN stays empty
+    """
+    if value != value:
+        return sheet.write_blank(row, column, None, cell_format)
+    #
+    return sheet.write_number(row, column, float(value), cell_format)
+### ======================================================================== ###
+
+
+
+class Sheet(object):
+    """
+    Description of a sheet without turning the values into Python lists.
+    The sheet is made of column groups, each column is a stack of segments:
+    a 2D numpy array has one row for each column of the group, a list holds
+    cells which are the same in every column of the group.
+    """
+    def __init__(self, name):
+        """
+        """
+        self.name = name
+        self.parts = []
+        #
+        return None
+    ### =================================================================== ###
+    def add_columns(self, *segments):
+        """
+        Add a group of columns made of the segments stacked on each other
+        """
+        number_of_columns = 1
+        for segment in segments:
+            if isinstance(segment, np.ndarray):
+                number_of_columns = segment.shape[0]
+                break
+        #
+        starts = [0]
+        for segment in segments:
+            if isinstance(segment, np.ndarray):
+                starts.append(starts[-1] + segment.shape[1])
+            else:
+                starts.append(starts[-1] + len(segment))
+        #
+        self.parts.append((segments, number_of_columns, starts))
+        #
+        return None
+    ### =================================================================== ###
+    @property
+    def number_of_rows(self):
+        return max([starts[-1] for segments, number_of_columns, starts in self.parts] + [0])
+    ### =================================================================== ###
+    @property
+    def number_of_columns(self):
+        return sum([number_of_columns for segments, number_of_columns, starts in self.parts])
+    ### =================================================================== ###
+    def columns(self):
+        """
+        Generator of the columns as lists, only one column is converted at a
+        time
+        """
+        for segments, number_of_columns, starts in self.parts:
+            for column in xrange(number_of_columns):
+                cells = []
+                for segment in segments:
+                    if isinstance(segment, np.ndarray):
+                        cells.extend(segment[column].tolist())
+                    else:
+                        cells.extend(segment)
+                yield cells
+    ### =================================================================== ###
+    def rows(self):
+        """
+        Generator of the rows as lists, the numbers of a column group are
+        converted one row at a time
+        """
+        for row in xrange(self.number_of_rows):
+            cells = []
+            for segments, number_of_columns, starts in self.parts:
+                # Below the end of the column group
+                if row >= starts[-1]:
+                    cells.extend([None] * number_of_columns)
+                    continue
+                #
+                index = bisect_right(starts, row) - 1
+                segment = segments[index]
+                if isinstance(segment, np.ndarray):
+                    cells.extend(segment[:, row - starts[index]].tolist())
+                else:
+                    cells.extend([segment[row - starts[index]]] * number_of_columns)
+            yield cells
+    ### =================================================================== ###
+    ### =================================================================== ###
+    ### =================================================================== ###
+
+
 
 
 class Excel(object):
@@ -22,33 +132,56 @@ class Excel(object):
         #
         return None
     ### =================================================================== ###
-    def add_sheet(self, sheetname, data):
+    def add_sheet(self, sheetname, data, number_of_columns = None):
         """
+        data: list of the columns, or any iterable of them if the number of
+        columns is given. The columns are written one after the other, every
+        column_limit columns go to a new sheet.
         """
-        column_start = 0
+        if number_of_columns is None:
+            number_of_columns = len(data)
         #
-        for sheet_index in xrange((len(data) / self.column_limit) + 1):
-            #    
-            self.sheet_names.append(''.join((sheetname, '_', str(sheet_index + 1))))
-            #
-            sheet = self.workbook.add_sheet(self.sheet_names[-1])
+        sheets = []
+        for sheet_index in xrange((number_of_columns / self.column_limit) + 1):
             #
-            column_end = len(data) - column_start
-            if column_end > self.column_limit:
-                column_end = self.column_limit
+            self.sheet_names.append(''.join((sheetname, '_', str(sheet_index + 1))))
             #
-            for column in xrange(column_end):
-                for row in xrange(len(data[column_start + column])):
-                    #
-                    try:
-                        value = float(data[column_start + column][row])
-                    except ValueError:
-                        value = data[column_start + column][row]
-                    #
-                    sheet.write(row, column, value)
+            sheets.append(self.workbook.add_sheet(self.sheet_names[-1]))
+        # Row objects of the current sheet
+        rows = []
+        #
+        for index, cells in enumerate(data):
+            column = index % self.column_limit
+            if column == 0:
+                sheet = sheets[index / self.column_limit]
+                rows = []
+            while len(rows) < len(cells):
+                rows.append(sheet.row(len(rows)))
             #
-            column_start += column_end
-        # 
+            for row, cell in enumerate(cells):
+                # Numbers of the numpy arrays, missing values (NaN) stay empty
+                if isinstance(cell, float):
+                    if cell == cell:
+                        rows[row].set_cell_number(column, cell)
+                    continue
+                #
+                try:
+                    value = float(cell)
+                except ValueError:
+                    value = cell
+                if value != value:
+                    continue
+                #
+                rows[row].write(column, value)
+        #
+        return None
+    ### =================================================================== ###
+    def write_sheet(self, sheet):
+        """
+        Write a Sheet description, the columns are made one at a time
+        """
+        self.add_sheet(sheet.name, sheet.columns(), sheet.number_of_columns)
+        #
         return None
     ### =================================================================== ###
     def save_excel_file(self, filename):
@@ -61,3 +194,71 @@ class Excel(object):
     ### =================================================================== ###
     ### =================================================================== ###
 
+
+
+
+class XlsxExcel(object):
+    """
+    .xlsx workbook written in constant memory mode: every sheet is written row
+    by row straight into the file, so nothing has to be split into several
+    sheets (16384 columns are allowed).
+    """
+    def __init__(self, filename):
+        """
+        """
+        if xlsxwriter is None:
+            raise ImportError('The xlsxwriter package is needed to write .xlsx files')
+        #
+        self.workbook = xlsxwriter.Workbook(filename, {'constant_memory' : True})
+        #
+        self.sheet_names = []
+        #
+        return None
+    ### =================================================================== ###
+    def add_sheet(self, sheetname, data):
+        """
+        data is a list of columns (lists or numpy arrays)
+        """
+        sheet = self.new_worksheet(sheetname)
+        # ---------------------------
+        # Numpy columns are converted at once, short columns end in blanks
+        # ---------------------------
+        columns = [column.tolist() if isinstance(column, np.ndarray) else column
+                   for column in data]
+        for row, values in enumerate(izip_longest(*columns)):
+            sheet.write_row(row, 0, values)
+        #
+        return None
+    ### =================================================================== ###
+    def write_sheet(self, sheet):
+        """
+        Write a Sheet description row by row
+        """
+        worksheet = self.new_worksheet(sheet.name)
+        for row, values in enumerate(sheet.rows()):
+            worksheet.write_row(row, 0, values)
+        #
+        return None
+    ### =================================================================== ###
+    def new_worksheet(self, sheetname):
+        """
+        """
+        # Sheet names are at most 31 characters without []:*?/\
+        self.sheet_names.append(re.sub(r'[\[\]:*?/\\]', '_', sheetname)[:31])
+        #
+        sheet = self.workbook.add_worksheet(self.sheet_names[-1])
+        for number_type in (float, np.float32, np.float64, np.int32, np.int64):
+            sheet.add_write_handler(number_type, write_number_or_blank)
+        #
+        return sheet
+    ### =================================================================== ###
+    def save_excel_file(self, filename = None):
+        """
+        The file name was given when the workbook was created
+        """
+        self.workbook.close()
+        #
+        return None
+    ### =================================================================== ###
+    ### =================================================================== ###
+    ### =================================================================== ###
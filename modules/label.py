@@ -12,6 +12,7 @@ Handle the label file
 
 import numpy as np
 import xlrd
+from modules.layout import get_layout
 
 
 class Label(object):
@@ -20,7 +21,6 @@ class Label(object):
     def __init__(self):
         """
         """
-        self.row_names = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
         self.block_info = []
         #
         return None
@@ -39,6 +39,8 @@ class Label(object):
         self.all_labels = {}
         self.label_types = {}
         self.well_order = []
+        # label of each well on each sheet
+        sheet_values = []
         # Go through all sheets
         for sheet_index, sheet_name in enumerate(book.sheet_names()):
             #
@@ -52,13 +54,18 @@ class Label(object):
             #
             # ----------------------
             self.label_types[sheet_index] = set()
+            sheet_values.append({})
+            # ----------------------
+            # Well names of the sheet: A1, A2, ..., H11, H12 or ..., AF48
+            # ----------------------
+            well_names = get_layout(max(sheet.nrows - 1, 0), max(sheet.ncols - 1, 0)).well_names.tolist()
             # ----------------------
             # Read the labels from the sheet
             # ----------------------
             for row in xrange(1, sheet.nrows):
                 for col in xrange(1, sheet.ncols):
-                    # Well name goes from A1, A2, ..., H11, H12
-                    well_name = self.row_names[row - 1] + str(col)
+                    # Well name from the layout
+                    well_name = well_names[(row - 1) * (sheet.ncols - 1) + col - 1]
                     # Read the label for the well
                     well_value = str(sheet.cell_value(row, col))
                     # Forgot about the empty wells
@@ -72,6 +79,11 @@ class Label(object):
                         if well_name not in self.all_labels:
                             self.all_labels[well_name] = []
                         self.all_labels[well_name].append(well_value)
+                        sheet_values[sheet_index][well_name] = well_value
+        # ----------------------
+        # Label codes of the wells on each sheet
+        # ----------------------
+        self._build_label_table(sheet_values)
         # ----------------------
         # Group corresponding labels together
         # ----------------------
@@ -80,43 +92,125 @@ class Label(object):
         print self.well_order
         return None
     ### ==================================================================== ###
-    def create_tag(self, well_name, block):
+    def _build_label_table(self, sheet_values):
         """
+        sheet_labels[sheet] is the sorted list of the labels of the sheet,
+        label_codes[well index, sheet] is the index of the label of the well in
+        sheet_labels[sheet] (-1 if the well has no label on that sheet) and
+        varying_sheets marks the sheets with more than one kind of label.
         """
-        tag = ''
-        well_name = self.all_labels[well_name][:block + 1]
+        number_of_sheets = len(sheet_values)
+        self.sheet_labels = []
+        self.label_codes = np.empty((len(self.well_order), number_of_sheets), dtype = np.int32)
+        self.varying_sheets = np.zeros(number_of_sheets, dtype = np.bool8)
         #
-        for i in xrange(len(well_name)):
+        for sheet in xrange(number_of_sheets):
+            labels = sorted(self.label_types[sheet])
+            codes = dict((label, code) for code, label in enumerate(labels))
             #
-            if len(self.label_types[i]) > 1:
-                tag = ''.join((tag, well_name[i], ';'))
+            self.sheet_labels.append(labels + [''])
+            self.label_codes[:, sheet] = [codes.get(sheet_values[sheet].get(well), -1)
+                                          for well in self.well_order]
+            self.varying_sheets[sheet] = len(labels) > 1
+        #
+        self._label_groups = {}
+        #
+        return None
+    ### ==================================================================== ###
+    def label_groups(self, sheets, separation_character = ';'):
+        """
+        Wells with the same labels on the selected sheets (boolean mask) form a
+        group. Returns the sorted group names, made of the labels joined by the
+        separation character, and the group code of each well.
+        """
+        key = (tuple(sheets), separation_character)
+        if key not in self._label_groups:
+            #
+            sheet_indices = np.flatnonzero(sheets)
+            if len(sheet_indices) == 0:
+                names = ['']
+                codes = np.zeros(len(self.well_order), dtype = np.int32)
+            else:
+                # ----------------------
+                # Each distinct label combination once
+                # ----------------------
+                combinations, codes = np.unique(self.label_codes[:, sheet_indices],
+                                                axis = 0, return_inverse = True)
+                names = [separation_character.join([self.sheet_labels[sheet][code]
+                                                    for sheet, code in zip(sheet_indices, combination)])
+                         for combination in combinations]
+                # ----------------------
+                # Codes follow the sorted names
+                # ----------------------
+                name_order = sorted(xrange(len(names)), key = names.__getitem__)
+                new_codes = np.empty(len(names), dtype = np.int32)
+                new_codes[name_order] = np.arange(len(names))
+                names = [names[i] for i in name_order]
+                codes = new_codes[codes]
+            #
+            self._label_groups[key] = (names, codes)
+        #
+        return self._label_groups[key]
+    ### ==================================================================== ###
+    def block_sheets(self, block, full_name = False, include_block_sheet = True):
+        """
+        Sheets used in the name of a block: the sheets up to the block's sheet,
+        only the varying ones unless full_name is True
+        """
+        sheets = np.arange(len(self.sheet_labels))
+        if include_block_sheet:
+            selected = sheets <= self.block_info[block]
+        else:
+            selected = sheets < self.block_info[block]
+        if not full_name:
+            selected &= self.varying_sheets
+        #
+        return selected
+    ### ==================================================================== ###
+    def create_tag(self, well_name, block):
+        """
+        block: index of the sheet
+        """
+        well_index = self.well_order.index(well_name)
+        sheets = self.varying_sheets & (np.arange(len(self.sheet_labels)) <= block)
+        names, codes = self.label_groups(sheets)
         #
-        return tag[:-1]
+        return names[codes[well_index]]
     ### ==================================================================== ###
     def _group_wells(self):
         """
+        group_labels[block][tag] lists the indices of the wells of the group.
+        For each block: group_names is the sorted list of the group labels,
+        group_codes is the index of the group of each well in group_names,
+        group_order lists the well indices group after group and the wells of
+        group i are group_order[group_offsets[i]:group_offsets[i + 1]]
         """
         self.group_labels = {}
+        self.group_names = {}
+        self.group_codes = {}
+        self.group_order = {}
+        self.group_offsets = {}
         # ----------------------
         # create a group label for each block of addition
         # ----------------------
-        for block_index, block in enumerate(self.block_info):
+        for block_index in xrange(len(self.block_info)):
+            #
+            names, codes = self.label_groups(self.block_sheets(block_index))
+            # Stable sort keeps the well order within the groups
+            order = np.argsort(codes, kind = 'mergesort')
+            offsets = np.zeros(len(names) + 1, dtype = np.int64)
+            offsets[1:] = np.cumsum(np.bincount(codes, minlength = len(names)))
+            #
+            self.group_names[block_index] = names
+            self.group_codes[block_index] = codes
+            self.group_order[block_index] = order
+            self.group_offsets[block_index] = offsets
             # ----------------------
             # group_labels contains information for each block
             # ----------------------
-            self.group_labels[block_index] = {}
-            # ----------------------
-            # Each well index appends to the corresponding label
-            # ----------------------
-            for well_index, well in enumerate(self.well_order):
-                #
-                tag = self.create_tag(well, block)
-#                tag = ';'.join((self.all_labels[well][:block + 1]))
-                #
-                if tag not in self.group_labels[block_index]:
-                    self.group_labels[block_index][tag] = []
-                #
-                self.group_labels[block_index][tag].append(well_index)
+            self.group_labels[block_index] = dict(
+                         (name, order[offsets[group]:offsets[group + 1]].tolist())
+                         for group, name in enumerate(names))
         #
         return None
     ### ==================================================================== ###
@@ -126,22 +220,30 @@ class Label(object):
         """
         return self.group_labels[block_number]
     ### ==================================================================== ###
+    def get_group_table(self, block_number):
+        """
+        Group names, well indices ordered by group and the group offsets
+        """
+        return (self.group_names[block_number],
+                self.group_order[block_number],
+                self.group_offsets[block_number])
+    ### ==================================================================== ###
+    def get_label_names(self, block, full_name = False, separation_character = ';'):
+        """
+        Label name of every well for the block
+        """
+        names, codes = self.label_groups(self.block_sheets(block, full_name, False),
+                                         separation_character)
+        #
+        return [names[code] for code in codes]
+    ### ==================================================================== ###
     def get_well_label_name(self, well_index, block, full_name = False, separation_character = ';'):
         """
         """
-        tag = ''
-        for i in xrange(self.block_info[block]):
-            # ----------------------
-            # Skip non unique labels
-            # ----------------------
-            if (full_name or (len(self.label_types[i]) > 1)):
-                # Add tags together
-                tag = ''.join((tag,
-                               self.all_labels[self.well_order[well_index]][i],
-                               separation_character,
-                             ))
+        names, codes = self.label_groups(self.block_sheets(block, full_name, False),
+                                         separation_character)
         #
-        return tag[:-1]
+        return names[codes[well_index]]
     ### ==================================================================== ###
     def longest_label_length(self, block):
         """
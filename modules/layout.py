@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Under GPL licence.
+
+Purpose:
+========
+Plate layout: row/column <-> well index <-> well name ('A1', 'AF48')
+
+"""
+
+import numpy as np
+
+
+# (rows, columns) of the plate formats
+PLATE_FORMATS = {6 : (2, 3),
+                 12 : (3, 4),
+                 24 : (4, 6),
+                 48 : (6, 8),
+                 96 : (8, 12),
+                 384 : (16, 24),
+                 1536 : (32, 48),
+                }
+# Layouts already made
+_layouts = {}
+
+
+def row_name(row):
+    """
+    Name of the row from its index: A..Z, then AA, AB, ... (1536 well plates
+    go up to AF)
+    """
+    name = ''
+    row += 1
+    while row > 0:
+        row, letter = divmod(row - 1, 26)
+        name = chr(ord('A') + letter) + name
+    #
+    return name
+### ======================================================================== ###
+
+def get_layout(rows, columns):
+    """
+    The layouts are shared, they never change
+    """
+    if (rows, columns) not in _layouts:
+        _layouts[(rows, columns)] = PlateLayout(rows, columns)
+    #
+    return _layouts[(rows, columns)]
+### ======================================================================== ###
+
+def get_plate_layout(plate_size):
+    """
+    Layout of a standard plate format (96, 384, 1536, ...)
+    """
+    if plate_size not in PLATE_FORMATS:
+        raise ValueError('Unknown plate format: ' + str(plate_size) + ' wells')
+    #
+    return get_layout(*PLATE_FORMATS[plate_size])
+### ======================================================================== ###
+
+
+
+
+class PlateLayout(object):
+    """
+    Wells are indexed row by row: A1, A2, ..., A12, B1, ...
+    Rows and columns are indexed from 0, the column names start with 1.
+    """
+    def __init__(self, rows, columns):
+        """
+        """
+        self.rows = int(rows)
+        self.columns = int(columns)
+        self.plate_size = self.rows * self.columns
+        # -----------------------------
+        # Lookup tables
+        # -----------------------------
+        self.row_names = np.array([row_name(row) for row in xrange(self.rows)])
+        self.column_names = np.array([str(column + 1) for column in xrange(self.columns)])
+        self.well_rows = np.repeat(np.arange(self.rows), self.columns)
+        self.well_columns = np.tile(np.arange(self.columns), self.rows)
+        self.well_names = np.char.add(self.row_names[self.well_rows],
+                                      self.column_names[self.well_columns])
+        self._well_indices = dict((name, index) for index, name in enumerate(self.well_names.tolist()))
+        #
+        return None
+    ### ==================================================================== ###
+    def well_index(self, rows, columns):
+        """
+        Well index from row and column indices (numbers or arrays)
+        """
+        return np.asarray(rows) * self.columns + np.asarray(columns)
+    ### ==================================================================== ###
+    def well_name(self, rows, columns):
+        """
+        Well name(s) from row and column indices (numbers or arrays)
+        """
+        return self.well_names[self.well_index(rows, columns)]
+    ### ==================================================================== ###
+    def well_indices(self, names):
+        """
+        Well indices of a list of well names
+        """
+        try:
+            return np.array([self._well_indices[name] for name in names], dtype = np.int64)
+        except KeyError as error:
+            raise ValueError('No well ' + str(error) + ' on a ' + str(self.plate_size) + ' well plate')
+    ### ==================================================================== ###
+    def position(self, names):
+        """
+        Row and column indices of a list of well names
+        """
+        indices = self.well_indices(names)
+        #
+        return self.well_rows[indices], self.well_columns[indices]
+    ### ==================================================================== ###
+    ### ==================================================================== ###
+    ### ==================================================================== ###
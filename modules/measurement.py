@@ -12,13 +12,188 @@ Handle a plate reader measument file
 
 import numpy as np
 import os
+import tempfile
+import warnings
+from itertools import imap
+from itertools import izip
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from modules.block import Block
+from modules.reader import read_lines
+from modules.reader import read_block_lines
+from modules.reader import is_kinetic_plate
+from modules.reader import load_block_index
+from modules.reader import read_block_lines_at
 from modules.label import Label
 from modules.excel import Excel
-from modules.plot import plot_response
-from modules.plot import plot_start_slopes
-from modules.plot import plot_mean_curve
-from modules.plot import plot_baseline
+from modules.excel import XlsxExcel
+from modules.excel import Sheet
+from modules.cache import FigureCache
+from modules.cache import data_hash
+from modules.cache import file_hash
+from modules.profiling import Profiler
+from modules.profiling import profiled_stage
+
+
+# Number of values sigma clipped at once, it limits the temporary arrays
+CLIP_CHUNK_SIZE = 2**20
+
+
+def load_block(arguments, profiler = None):
+    """
+    Parse one block of the file from its byte offsets. It runs in the worker
+    processes, so it has to be a module level function.
+    profiler: the parse_block stage is recorded by this Profiler, by a new
+    one if None (in the workers).
+    Returns the Block, None if the block is not a plate formated kinetic
+    measurement, and the stage records of the new profiler.
+    """
+    datafilename, encoding, start, end, wells, block = arguments
+    records = []
+    if profiler is None:
+        profiler = Profiler()
+        records = profiler.records
+    #
+    block_lines = read_block_lines_at(datafilename, encoding, start, end)
+    if not is_kinetic_plate(block_lines[0]):
+        return None, records
+    #
+    with profiler.stage('parse_block', block):
+        data = Block(block_lines, wells)
+    #
+    return data, records
+### ======================================================================== ###
+
+def render_figure(job):
+    """
+    Make one figure: job is the name of the plotting function of
+    modules.plot and its arguments. It runs in the worker processes, so it
+    has to be a module level function. Returns the list of the saved files.
+    """
+    from modules import plot
+    #
+    if job[0] == 'plot_mean_curve_block':
+        open_traces(job[2])
+    #
+    return getattr(plot, job[0])(*job[1:])
+### ======================================================================== ###
+
+def open_traces(statistics):
+    """
+    Traces of the mean curve groups which are sent as (file of the plate
+    values, end of the block): the rows of the group are read from the
+    memory mapped file in the worker, not sent through the pool
+    """
+    plates = {}
+    for group in statistics:
+        if 'trace_file' not in statistics[group]:
+            continue
+        filename, end = statistics[group].pop('trace_file')
+        if filename not in plates:
+            plates[filename] = np.load(filename, mmap_mode = 'r')
+        statistics[group]['original_data'] = np.asarray(plates[filename][statistics[group]['rows'], :end])
+    #
+    return None
+### ======================================================================== ###
+
+def baseline_block(block_names):
+    """
+    Index of the block the data is normalized to: the last block with
+    'baseline' in its name, the first block if there is none
+    """
+    baseline = 0
+    for block, name in enumerate(block_names):
+        if 'baseline' in name:
+            baseline = block
+    #
+    return baseline
+### ======================================================================== ###
+
+def clip_groups(values, sizes, sigma):
+    """
+    Sigma clipped mean, std and number of data of every column of groups of
+    consecutive rows (rows x columns array, sizes: number of rows of each
+    group, none of them empty). NaN values are ignored. If every value of a
+    column of a group is clipped all its values are used. Computed with
+    grouped sums, returns (groups x columns) arrays.
+    """
+    starts = np.cumsum(sizes) - sizes
+    #
+    def group_sum(values):
+        return np.add.reduceat(values, starts, axis = 0)
+    #
+    def group_mean_std(keep):
+        number = group_sum(keep)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            mean = group_sum(np.where(keep, values, 0.0)) / number
+            deviation = values - np.repeat(mean, sizes, axis = 0)
+            std = np.sqrt(group_sum(np.where(keep, deviation**2, 0.0)) / number)
+        return mean, std, number, deviation
+    # ------------------------
+    # Values within sigma * std from the mean of their group
+    # ------------------------
+    valid = ~np.isnan(values)
+    mean, std, number, deviation = group_mean_std(valid)
+    with np.errstate(invalid = 'ignore'):
+        keep = valid & (np.absolute(deviation) < np.repeat(std * sigma, sizes, axis = 0))
+    # ------------------------
+    # Everything was clipped, use the whole column of the group
+    # ------------------------
+    clipped_all = group_sum(keep) == 0
+    keep |= valid & np.repeat(clipped_all, sizes, axis = 0)
+    #
+    mean, std, number, deviation = group_mean_std(keep)
+    #
+    return mean, std, number
+### ======================================================================== ###
+
+def sigma_clip(data, rows, offsets, sigma, chunk_size = CLIP_CHUNK_SIZE):
+    """
+    Sigma clipped mean, std and number of data of groups of rows (clip_groups
+    of all groups at once). The rows of group i are
+    data[rows[offsets[i]:offsets[i + 1]]], all rows in their order if rows is
+    None. 1D data is handled as a single column. The columns are processed in
+    chunks of about chunk_size values, only one chunk of the group ordered
+    rows is converted to float64 at a time. Empty groups get NaN.
+    Returns (groups x columns) arrays.
+    """
+    if np.ndim(data) == 1:
+        data = data[:, np.newaxis]
+    sizes = np.diff(offsets)
+    filled = sizes > 0
+    number_of_rows = sizes.sum()
+    number_of_columns = data.shape[1]
+    #
+    mean = np.empty((len(sizes), number_of_columns), dtype = np.float64)
+    mean.fill(np.nan)
+    std = mean.copy()
+    number = np.zeros((len(sizes), number_of_columns), dtype = np.int64)
+    if number_of_rows == 0:
+        return mean, std, number
+    #
+    step = max(1, chunk_size // number_of_rows)
+    for start in xrange(0, number_of_columns, step):
+        stop = min(start + step, number_of_columns)
+        if rows is None:
+            values = data[:, start:stop].astype(np.float64)
+        else:
+            values = data[rows, start:stop].astype(np.float64)
+        mean[filled, start:stop], std[filled, start:stop], number[filled, start:stop] = (
+            clip_groups(values, sizes[filled], sigma))
+    #
+    return mean, std, number
+### ======================================================================== ###
+
+
+
+
+class MeasurementCancelled(Exception):
+    """
+    The running stage was stopped by setting the cancel event
+    """
+    pass
+
+
 
 
 class Measurement(object):
@@ -29,28 +204,175 @@ class Measurement(object):
         """
         self.label = None
         self.sigma = 1.5
+        # PlateCache object to reload already parsed files, no cache if None
+        self.cache = None
+        # Number of blocks parsed at the same time by 'process' or 'thread' workers
+        self.workers = 1
+        self.worker_type = 'process'
+        # Called with (stage, done, total) as the stages go on, e.g. to move
+        # a progress bar. It is called from the thread running the stage.
+        self.progress = None
+        # threading.Event, when it is set the running stage stops with
+        # MeasurementCancelled
+        self.cancel = None
+        # Time and memory of the stages
+        self.profiler = Profiler()
         #
         return None
     ### ==================================================================== ###
-    def read_measurement_datafile(self, datafilename):
+    def report_progress(self, stage, done, total):
         """
+        Progress of a stage, this is also where a stage can be cancelled
+        """
+        if (self.cancel is not None) and self.cancel.is_set():
+            raise MeasurementCancelled(stage)
+        if self.progress is not None:
+            self.progress(stage, done, total)
+        #
+        return None
+    ### ==================================================================== ###
+    @profiled_stage('read_measurement_datafile')
+    def read_measurement_datafile(self, datafilename, blocks = None, wells = None):
+        """
+        blocks: list of block indices or block names to load, all if None. The
+                baseline block has to be one of them, the response and slope
+                of a block are calculated from the previous loaded block.
+        wells: list of well names to load, all if None
         """
         self._datafilename = datafilename
+        self.well_selection = wells
+        use_cache = (self.cache is not None) and (blocks is None) and (wells is None)
         # ------------------------
-        # Read the whole file once
+        # Parsed and normalized plate from the cache
         # ------------------------
-        with open(datafilename, 'r') as datafile:
-            # Replace \x00 to nothing, split the lines, remove extra, split by tab
-            lines = [line.strip().split('\t') for line in
-                               datafile.read().replace('\x00', '').splitlines()]
+        if use_cache:
+            cached = self.cache.load(datafilename)
+            if cached is not None:
+                self.separate_block_information(*cached)
+                self.report_progress('reading', 1, 1)
+                return None
         # ------------------------
-        # Plate formated Kinetic measurements
+        # Blocks are built while the file is read
         # ------------------------
-        if ((lines[1][3] == 'PlateFormat') and (lines[1][4] == 'Kinetic')):
-            self.separate_block_information(lines)
+        self.separate_block_information(self.iterate_blocks(datafilename, blocks, wells))
+        self.normalize_data()
+        self.report_progress('reading', 1, 1)
+        #
+        if use_cache:
+            with self.profiler.stage('cache_store'):
+                self.cache.store(datafilename,
+                                 [(self.block_indices[block], self.data[block])
+                                  for block in xrange(self.number_of_blocks)],
+                                 self.raw_values,
+                                 self.values,
+                                 self.block_offsets)
         #
         return None
     ### ==================================================================== ###
+    def iterate_blocks(self, datafilename, blocks = None, wells = None):
+        """
+        Generator of the (position in the file, Block object) pairs. A block is
+        created as soon as its end marker is read and its text is released
+        right after. Selected blocks, or all blocks when there are several
+        workers, are read directly using the block index of the file.
+        """
+        if (blocks is not None) or (self.workers > 1):
+            for block, data in self.iterate_selected_blocks(datafilename, blocks, wells):
+                yield block, data
+            return
+        #
+        lines = read_lines(datafilename)
+        # ------------------------
+        # Number of blocks is in the first line
+        # ------------------------
+        number_of_blocks = int(next(lines)[0].split()[-1])
+        #
+        for block, block_lines in enumerate(read_block_lines(lines)):
+            if block == number_of_blocks:
+                break
+            # ------------------------
+            # Plate formated Kinetic measurements only
+            # ------------------------
+            if not is_kinetic_plate(block_lines[0]):
+                self.report_progress('reading', block + 1, number_of_blocks + 1)
+                continue
+            #
+            with self.profiler.stage('parse_block', block):
+                data = Block(block_lines, wells)
+            del block_lines
+            self.report_progress('reading', block + 1, number_of_blocks + 1)
+            #
+            yield block, data
+    ### ==================================================================== ###
+    def iterate_selected_blocks(self, datafilename, blocks = None, wells = None):
+        """
+        Seek to the requested blocks (all if None) and parse only those. The
+        blocks are parsed by a pool of workers if there is more than one.
+        """
+        index = load_block_index(datafilename)
+        if blocks is None:
+            selected = range(len(index['offsets']))
+        else:
+            selected = self.select_blocks(index, blocks)
+            # ------------------------
+            # Every block is normalized to the baseline block
+            # ------------------------
+            baseline = baseline_block(index['names'])
+            if baseline not in selected:
+                raise ValueError(''.join(('The baseline block (number ', str(baseline), ', ',
+                                          index['names'][baseline], ') has to be loaded, ',
+                                          'the data is normalized to it')))
+        #
+        jobs = [(datafilename, index['encoding']) + tuple(index['offsets'][block]) + (wells, block)
+                for block in selected]
+        # ------------------------
+        # Blocks are independent, parse them at the same time. The workers
+        # send back their parse_block records. A cProfile of parse_block
+        # needs the parsing in this process.
+        # ------------------------
+        pool = None
+        if ((self.workers > 1) and (len(jobs) > 1) and
+            (self.profiler.profile_stage != 'parse_block')):
+            if self.worker_type == 'thread':
+                pool = ThreadPool(min(self.workers, len(jobs)))
+            else:
+                pool = Pool(min(self.workers, len(jobs)))
+            blocks = pool.imap(load_block, jobs)
+        else:
+            blocks = imap(load_block, jobs, [self.profiler] * len(jobs))
+        #
+        try:
+            for done, (block, (data, records)) in enumerate(izip(selected, blocks), 1):
+                self.profiler.records.extend(records)
+                self.report_progress('reading', done, len(selected) + 1)
+                # ------------------------
+                # Plate formated Kinetic measurements only
+                # ------------------------
+                if data is not None:
+                    yield block, data
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+    ### ==================================================================== ###
+    def select_blocks(self, index, blocks):
+        """
+        Sorted block indices from a list of block indices and/or names
+        """
+        selected = set()
+        for block in blocks:
+            if isinstance(block, basestring):
+                if block.lower() not in index['names']:
+                    raise ValueError('No block named ' + block)
+                selected.add(index['names'].index(block.lower()))
+            else:
+                if not (0 <= block < len(index['offsets'])):
+                    raise ValueError('No block number ' + str(block))
+                selected.add(block)
+        #
+        return sorted(selected)
+    ### ==================================================================== ###
+    @profiled_stage('read_label_datafile')
     def read_label_datafile(self, label_filename, time_of_addition_takes=30):
         """
         """
@@ -59,72 +381,112 @@ class Measurement(object):
         # Create a label object
         self.label = Label()
         # Read the label file content
-        self.label.read_label_file(label_filename)
+        with self.profiler.stage('read_label_file'):
+            self.label.read_label_file(label_filename)
+        # Rows of the labelled wells if only some wells were loaded
+        self.label_rows = self.find_label_rows()
         # Adjust the time
         for block in xrange(1, self.number_of_blocks):
             self.data[block].time_shift = self.data[block-1].time[-1] + time_of_addition_takes
         # Calculate the important parameters
+        self.report_progress('statistics', 1, 5)
         self.calculate_baseline()
+        self.report_progress('statistics', 2, 5)
         self.calculate_response()
+        self.report_progress('statistics', 3, 5)
         self.calculate_mean_curve()
+        self.report_progress('statistics', 4, 5)
         self.calculate_slope(time_of_addition_takes)
+        self.report_progress('statistics', 5, 5)
         #
         return None
     ### ==================================================================== ###
-    def separate_block_information(self, lines):
+    def separate_block_information(self, blocks, raw_values = None, values = None):
         """
+        Collect the blocks as they arrive from the reader. raw_values and
+        values are the plate arrays if the blocks already use them (cache).
         """
-        self.number_of_blocks = int(lines[0][0].split()[-1])
-        #
         self.data = {}
-        self.last_baseline = 0
+        self.block_indices = []
         #
-        start = 1
-        for block in xrange(self.number_of_blocks):
-            #
-            end = start
-            while ((end < len(lines)) and (not lines[end][0].startswith('~End'))):
-                end += 1
-            # ---------------------
-            # Extract the data
-            # ---------------------
-            self.data[block] = Block(lines[start:end])
+        for block, (position, data) in enumerate(blocks):
             # ---------------------
-            # Remember the last baseline index
+            # Store the data and where it was in the file
             # ---------------------
-            if 'baseline' in self.data[block].block_name:
-                self.last_baseline = block
-            #
-            start = end + 1
+            self.data[block] = data
+            self.block_indices.append(position)
+        #
+        self.number_of_blocks = len(self.data)
         # ---------------------
-        self.total_number_of_points = 0
+        # Remember the last baseline index
         # ---------------------
-        # Normalize data to the last baseline point
+        self.last_baseline = baseline_block([self.data[block].block_name
+                                             for block in xrange(self.number_of_blocks)])
         # ---------------------
+        # Contiguous storage of the whole plate
+        # ---------------------
+        self.build_plate_arrays(raw_values, values)
+        self.total_number_of_points = self.block_offsets[-1]
+        #
+        return None
+    ### ==================================================================== ###
+    def build_plate_arrays(self, raw_values = None, values = None):
+        """
+        All blocks are stored in one wells x timepoints array (raw_values and
+        values) and one time vector. block_offsets[block] is the first column
+        of the block, the blocks keep views of their own columns.
+        """
+        points = [self.data[block].value.shape[1] for block in xrange(self.number_of_blocks)]
+        self.block_offsets = np.zeros(self.number_of_blocks + 1, dtype = np.int64)
+        self.block_offsets[1:] = np.cumsum(points)
+        # ---------------------
+        # New arrays unless the blocks already live in the given ones
+        # ---------------------
+        copy = raw_values is None
+        if copy:
+            shape = (self.data[0].value.shape[0], self.block_offsets[-1])
+            raw_values = np.empty(shape, dtype = np.float32)
+            values = np.empty(shape, dtype = np.float32)
+        self.raw_values = raw_values
+        self.values = values
+        self.time = np.empty(self.block_offsets[-1], dtype = np.float64)
+        #
+        for block in xrange(self.number_of_blocks):
+            start = self.block_offsets[block]
+            end = self.block_offsets[block + 1]
+            self.data[block].use_storage(self.raw_values[:, start:end],
+                                         self.values[:, start:end],
+                                         self.time[start:end],
+                                         copy)
+        #
+        return None
+    ### ==================================================================== ###
+    @profiled_stage('normalize_data')
+    def normalize_data(self):
+        """
+        Normalize data to the last baseline point
+        """
         for block in self.data:
-            #
             self.data[block].normalize(self.data[self.last_baseline].raw_value[:, -1])
-            #
-            self.total_number_of_points += self.data[block].number_of_points
         #
         return None
     ### ==================================================================== ###
+    @profiled_stage('calculate_baseline')
     def calculate_baseline(self, number_of_data = 3):
         """
         """
-        self.baseline = {}
         block = self.last_baseline
-        # Get the corresponding labels
-        groups = self.label.get_group(block)
-        # Collect data for each group
-        for name in groups:
-            # Baseline
-            original_data = self.data[block].last(number_of_data, True)[groups[name]].mean(axis=1)
-            # Filter out outlier and store the result
-            self.baseline[name] = self.outlier_filter(original_data)
+        # Baseline of every well
+        with warnings.catch_warnings():
+            # Wells without any data give NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            original_data = np.nanmean(self.data[block].last(number_of_data, True), axis=1)
+        # Filter out outlier for all groups and store the result
+        self.baseline = self.grouped_outlier_filter(original_data, block)
         #
         return None
     ### ==================================================================== ###
+    @profiled_stage('calculate_response')
     def calculate_response(self):
         """
         Response of each block is the difference between the max value in block
@@ -133,21 +495,17 @@ class Measurement(object):
         self.response = {}
         # Go through each block except the first
         for block in xrange(1, self.number_of_blocks):
-            #
-            self.response[block] = {}
-            # Get the corresponding labels
-            groups = self.label.get_group(block)
-            # Collect data for each group
-            for name in groups:
-                #
+            with self.profiler.stage('calculate_response', block):
+                # Response of every well
                 original_data = self.data[block].difference(
                                 previous_block_last_elements=self.data[block - 1].last()[0],
-                                use_max=block < self.number_of_blocks - 1)[groups[name]]
-                # Filter out outlier and store the result
-                self.response[block][name] = self.outlier_filter(original_data)
+                                use_max=block < self.number_of_blocks - 1)
+                # Filter out outlier for all groups and store the result
+                self.response[block] = self.grouped_outlier_filter(original_data, block)
         #
         return None
     ### ==================================================================== ###
+    @profiled_stage('calculate_mean_curve')
     def calculate_mean_curve(self):
         """
         """
@@ -155,77 +513,181 @@ class Measurement(object):
         self.mean_time = {}
         # Go through each block
         for block in xrange(self.number_of_blocks):
-            #
-            self.mean_curve[block] = {}
-            self.mean_time[block] = {}
-            # Get the corresponding labels
-            groups = self.label.get_group(block)
-            # Collect data for each group
-            for name in groups:
-                # Traces
-                original_data = np.hstack([self.data[previous_block].value[groups[name], :]
-                                          for previous_block in xrange(block + 1)])
-                # Filter out outlier and store the result
-                self.mean_curve[block][name] = self.outlier_filter(original_data)
+            with self.profiler.stage('calculate_mean_curve', block):
+                # Traces from the start up to the end of this block
+                end = self.block_offsets[block + 1]
+                # Filter out outlier for all groups and store the result
+                self.mean_curve[block] = self.grouped_outlier_filter(self.values[:, :end], block)
                 #
-                self.mean_time[block][name] = np.hstack([self.data[previous_block].time
-                                          for previous_block in xrange(block + 1)])
+                self.mean_time[block] = dict((name, self.time[:end]) for name in self.mean_curve[block])
         #
         return None
     ### ==================================================================== ###
+    @profiled_stage('calculate_slope')
     def calculate_slope(self, time_of_addition_takes):
         """
         """
         self.start_slope = {}
         # Go through each block except the first
         for block in xrange(1, self.number_of_blocks):
-            #
-            self.start_slope[block] = {}
-            # Get the corresponding labels
-            groups = self.label.get_group(block)
-            # Collect data for each group
-            for name in groups:
-                #
+            with self.profiler.stage('calculate_slope', block):
+                # Slope of every well
                 original_data = self.data[block].slope(self.data[block-1].last()[0],
-                                           time_of_addition_takes)[groups[name]]
-                # Filter out outlier and store the result
-                self.start_slope[block][name] = self.outlier_filter(original_data)
+                                                       time_of_addition_takes)
+                # Filter out outlier for all groups and store the result
+                self.start_slope[block] = self.grouped_outlier_filter(original_data, block)
         #
         return None
     ### ==================================================================== ###
-    def outlier_filter_1d(self, data):
+    def find_label_rows(self):
+        """
+        Row of each labelled well in the plate arrays (-1 if the well was not
+        loaded). None if every well was loaded, the rows follow the label well
+        order then.
+        """
+        if self.well_selection is None:
+            return None
+        #
+        rows = dict((well, row) for row, well in enumerate(self.data[0].wells))
+        label_rows = np.array([rows.get(well, -1) for well in self.label.well_order], dtype = np.int64)
+        if not (label_rows >= 0).any():
+            raise ValueError('None of the loaded wells has a label')
+        #
+        return label_rows
+    ### ==================================================================== ###
+    def labelled_wells(self):
+        """
+        Names of the loaded, labelled wells, their indices in the label well
+        order and their rows in the plate arrays
+        """
+        if self.label_rows is None:
+            number_of_wells = len(self.label.well_order)
+            return self.label.well_order, slice(0, number_of_wells), slice(0, number_of_wells)
+        #
+        labelled = np.flatnonzero(self.label_rows >= 0)
+        #
+        return [self.label.well_order[well] for well in labelled], labelled, self.label_rows[labelled]
+    ### ==================================================================== ###
+    def group_table(self, block):
         """
+        Label groups of a loaded block: the group names, the rows of the plate
+        arrays group after group and the group offsets. The label sheet is
+        found by the position of the block in the file, only the loaded wells
+        are used and the groups without any are left out.
         """
-        mask = np.absolute(data - data.mean()) < data.std() * self.sigma
-        if mask.sum() == 0:
-            mask = np.ones(data.shape, dtype = np.bool8)
+        position = self.block_indices[block]
+        if position not in self.label.group_names:
+            raise ValueError(''.join(('The label file has no sheet for block number ', str(position),
+                                      ' (', self.data[block].block_name, ')')))
+        names, rows, offsets = self.label.get_group_table(position)
+        if self.label_rows is None:
+            return names, rows, offsets
+        # ------------------------
+        # Loaded wells only
+        # ------------------------
+        rows = self.label_rows[rows]
+        loaded = rows >= 0
+        groups = np.repeat(np.arange(len(names)), np.diff(offsets))[loaded]
+        counts = np.bincount(groups, minlength = len(names))
+        names = [name for name, count in zip(names, counts) if count > 0]
+        offsets = np.zeros(len(names) + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum(counts[counts > 0])
         #
-        return data[mask]
+        return names, rows[loaded], offsets
     ### ==================================================================== ###
     def outlier_filter(self, data):
         """
+        Sigma clipping of every column of the data at once. Missing (NaN)
+        values are ignored. If every value of a column is clipped, all values
+        of the column are used. 1D data is handled as a single column.
         """
-        filtered_data = {'mean' : [],
-                         'std' : [],
-                         'len' : [],
-                         'original_data' : data}
-        # 1D data
-        if len(data.shape) == 1:
-            row = self.outlier_filter_1d(data)
-            #
-            filtered_data['mean'].append(row.mean())
-            filtered_data['std'].append(row.std())
-            filtered_data['len'].append(len(row))
-        else:
-            # 2D data
-            for i in xrange(data.shape[1]):
-                row = self.outlier_filter_1d(data[:, i])
-                filtered_data['mean'].append(row.mean())
-                filtered_data['std'].append(row.std())
-                filtered_data['len'].append(len(row))
+        mean, std, number = sigma_clip(data, None, np.array([0, len(data)]), self.sigma)
+        #
+        return {'mean' : mean[0],
+                'std' : std[0],
+                'len' : number[0],
+                'original_data' : data}
+    ### ==================================================================== ###
+    def grouped_outlier_filter(self, data, block):
+        """
+        outlier_filter of every label group of the block at once. data has
+        one row (or value) for each well, the result is a dictionary of the
+        groups with their mean, std, len and the rows of their wells. Only 1D
+        data (one value for each well) is copied into 'original_data', the
+        traces of 2D data are taken from the plate arrays when they are
+        needed (group_traces).
+        """
+        names, rows, offsets = self.group_table(block)
+        mean, std, number = sigma_clip(data, rows, offsets, self.sigma)
+        #
+        filtered_data = {}
+        for group, name in enumerate(names):
+            wells = rows[offsets[group]:offsets[group + 1]]
+            filtered_data[name] = {'mean' : mean[group],
+                                   'std' : std[group],
+                                   'len' : number[group],
+                                   'rows' : wells}
+            if np.ndim(data) == 1:
+                filtered_data[name]['original_data'] = data[wells]
         #
         return filtered_data
     ### ==================================================================== ###
+    def group_traces(self, block, group):
+        """
+        Normalized traces of the wells of a mean curve group, from the start up
+        to the end of the block
+        """
+        end = self.block_offsets[block + 1]
+        #
+        return self.values[self.mean_curve[block][group]['rows'], :end]
+    ### ==================================================================== ###
+    def figure_job(self, job, traces_filename = None):
+        """
+        The traces of a mean curve figure are added only when the figure is
+        made: the min/max envelope of each group if the profile does not
+        draw the traces, the name of the plate values file if the figure is
+        made by a worker process (traces_filename), the traces themselves
+        otherwise
+        """
+        if job[0] != 'plot_mean_curve_block':
+            return job
+        from modules.plot import render_settings
+        #
+        block = job[4]
+        draw_traces = render_settings(job[-1])['traces']
+        statistics = {}
+        for group in job[2]:
+            statistics[group] = dict(job[2][group])
+            if not draw_traces:
+                # Plain arrays, not views of a memory mapped file
+                traces = np.asarray(self.group_traces(block, group))
+                with warnings.catch_warnings():
+                    # Timepoints without any value give NaN
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    statistics[group]['envelope'] = (np.nanmin(traces, axis = 0),
+                                                     np.nanmax(traces, axis = 0))
+            elif traces_filename is not None:
+                statistics[group]['trace_file'] = (traces_filename, self.block_offsets[block + 1])
+            else:
+                statistics[group]['original_data'] = self.group_traces(block, group)
+        #
+        return job[:2] + (statistics,) + job[3:]
+    ### ==================================================================== ###
+    def traces_file(self):
+        """
+        .npy file of the normalized plate values for the figure workers: the
+        cached file if the plate was loaded from the cache, otherwise a
+        temporary file. Returns the file name and whether it is temporary.
+        """
+        if isinstance(self.values, np.memmap) and os.path.isfile(self.values.filename):
+            return self.values.filename, False
+        #
+        handle, filename = tempfile.mkstemp(suffix = '.npy')
+        with os.fdopen(handle, 'wb') as valuesfile:
+            np.save(valuesfile, self.values)
+        #
+        return filename, True
+    ### ==================================================================== ###
     def info(self):
         """
         """
@@ -240,193 +702,143 @@ class Measurement(object):
         #
         return info_text
     ### ==================================================================== ###
+    @profiled_stage('save_datafile')
     def save_datafile(self, save_excel_filename):
         """
         """
-        workbook = Excel()
+        if save_excel_filename.lower().endswith('.xlsx'):
+            workbook = XlsxExcel(save_excel_filename)
+        else:
+            workbook = Excel()
+        # Progress after each sheet
+        number_of_sheets = 2 * len(self.mean_curve) + 2 + 2 * len(self.response)
+        written = [0]
+        def write_sheet(sheet):
+            workbook.write_sheet(sheet)
+            written[0] += 1
+            self.report_progress('saving', written[0], number_of_sheets + 1)
         # ---------------------------
         # Grouped normalized data
         # ---------------------------
         for block in self.mean_curve:
-            data = []
+            end = self.block_offsets[block + 1]
+            sheet = Sheet('grouped_' + self.data[block].block_name)
             # Header
-            a = ['Time']
-            for time in self.mean_time[block][self.mean_time[block].keys()[0]]:
-                a.append(time)
-            data.append(a)
-            # Values
+            sheet.add_columns(['Time'], self.time[np.newaxis, :end])
+            # Values, the group name is above its first well
             for group in self.mean_curve[block]:
-                for column in xrange(len(self.mean_curve[block][group]['original_data'])):
-                    if column == 0:
-                        a = [group]
-                    else:
-                        a = ['']
-                    for value in self.mean_curve[block][group]['original_data'][column]:
-                        a.append(value)
-                    #
-                    data.append(a)
-            workbook.add_sheet('grouped_' + self.data[block].block_name, data)
+                traces = self.group_traces(block, group)
+                names = np.array([group] + [''] * (len(traces) - 1), dtype = object)
+                sheet.add_columns(names[:, np.newaxis], traces)
+            write_sheet(sheet)
         # ---------------------------
         # Raw and normalized data
         # ---------------------------
-        data = []
-        # Header 1
-        a = ['']
-        a.append('Raw data')
-        a.append('Block')
-        for block in self.data:
-            for time in self.data[block].time:
-                a.append(self.data[block].block_name)
-        a.append('')
-        a.append('')
-        a.append('Normalized')
-        a.append('Block')
-        for block in self.data:
-            for time in self.data[block].time:
-                a.append(self.data[block].block_name)
-        data.append(a)
-        # Header 2
-        a = ['Label']
-        a.append('Raw data')
-        a.append('Time')
-        for block in self.data:
-            for time in self.data[block].time:
-                a.append(time)
-        a.append('')
-        a.append('')
-        a.append('Normalized')
-        a.append('Time')
-        for block in self.data:
-            for time in self.data[block].time:
-                a.append(time)
-        data.append(a)
+        sheet = Sheet('raw_data')
+        wells, _, rows = self.labelled_wells()
+        # Header 1: block of each timepoint
+        block_names = np.repeat(np.array([self.data[block].block_name for block in xrange(self.number_of_blocks)],
+                                         dtype = object),
+                                np.diff(self.block_offsets))
+        sheet.add_columns(['', 'Raw data', 'Block'], block_names[np.newaxis, :],
+                          ['', '', 'Normalized', 'Block'], block_names[np.newaxis, :])
+        # Header 2: time
+        sheet.add_columns(['Label', 'Raw data', 'Time'], self.time[np.newaxis, :],
+                          ['', '', 'Normalized', 'Time'], self.time[np.newaxis, :])
         # Values
-        for well_index in xrange(len(self.label.well_order)):
-            a = []
-            a.append(';'.join(self.label.all_labels[self.label.well_order[well_index]]))
-            a.append('Raw data')
-            a.append(self.label.well_order[well_index])
-            for block in self.data:
-                for value in self.data[block].raw_value[well_index]:
-                    a.append(value)
-            a.append('')
-            a.append('')
-            a.append('Normalized')
-            a.append(self.label.well_order[well_index])
-            for block in self.data:
-                for value in self.data[block].value[well_index]:
-                    a.append(value)
-            data.append(a)
-        workbook.add_sheet('raw_data', data)
+        labels = np.array([';'.join(self.label.all_labels[well]) for well in wells],
+                          dtype = object)[:, np.newaxis]
+        well_names = np.array(wells, dtype = object)[:, np.newaxis]
+        sheet.add_columns(labels, ['Raw data'], well_names, self.raw_values[rows],
+                          ['', '', 'Normalized'], well_names, self.values[rows])
+        write_sheet(sheet)
         # ---------------------------
         # Mean
         # ---------------------------
         for block in self.mean_curve:
-            data = []
+            end = self.block_offsets[block + 1]
+            sheet = Sheet('mean_' + self.data[block].block_name)
             # Header
-            a = ['Time']
-            for time in self.mean_time[block][self.mean_time[block].keys()[0]]:
-                a.append(time)
-            a.append('')
-            a.append('Std')
-            for time in self.mean_time[block][self.mean_time[block].keys()[0]]:
-                a.append(time)
-            data.append(a)
+            sheet.add_columns(['Time'], self.time[np.newaxis, :end],
+                              ['', 'Std'], self.time[np.newaxis, :end])
             # Values
-            for group in self.mean_curve[block]:
-                a = [group]
-                for value in self.mean_curve[block][group]['mean']:
-                    a.append(value)
-                a.append('')
-                a.append(group)
-                for value in self.mean_curve[block][group]['std']:
-                    a.append(value)
-
-                data.append(a)
-            workbook.add_sheet('mean_' + self.data[block].block_name, data)
+            groups = self.mean_curve[block].keys()
+            names = np.array(groups, dtype = object)[:, np.newaxis]
+            sheet.add_columns(names, np.array([self.mean_curve[block][group]['mean'] for group in groups]),
+                              [''], names, np.array([self.mean_curve[block][group]['std'] for group in groups]))
+            write_sheet(sheet)
         # ---------------------------
         # Baseline average
         # ---------------------------
-        data = []
-        # Header
-        a = ['Label']
-        for i in xrange(len(self.baseline[self.baseline.keys()[0]]['original_data'])):
-            a.append(i + 1)
-        a.append('')
-        a.append('Mean')
-        a.append('Std')
-        a.append('Number of data')
-        data.append(a)
-        # Values
-        for group in self.baseline:
-            a = [group]
-            for value in self.baseline[group]['original_data']:
-                a.append(value)
-            a.append('')
-            a.append(self.baseline[group]['mean'][0])
-            a.append(self.baseline[group]['std'][0])
-            a.append(self.baseline[group]['len'][0])
-            data.append(a)
-        workbook.add_sheet('baseline average', data)
+        write_sheet(self.statistics_sheet('baseline average', self.baseline))
         # ---------------------------
         # Peak response
         # ---------------------------
         for block in self.response:
-            data = []
-            # Header
-            a = ['Label']
-            for i in xrange(len(self.response[block][self.response[block].keys()[0]]['original_data'])):
-                a.append(i + 1)
-            a.append('')
-            a.append('Mean')
-            a.append('Std')
-            a.append('Number of data')
-            data.append(a)
-            # Values
-            for group in self.response[block]:
-                a = [group]
-                for value in self.response[block][group]['original_data']:
-                    a.append(value)
-                a.append('')
-                a.append(self.response[block][group]['mean'][0])
-                a.append(self.response[block][group]['std'][0])
-                a.append(self.response[block][group]['len'][0])
-                data.append(a)
-            workbook.add_sheet('peak_' + self.data[block].block_name, data)
+            write_sheet(self.statistics_sheet('peak_' + self.data[block].block_name,
+                                                       self.response[block]))
         # ---------------------------
         # Slope
         # ---------------------------
         for block in self.response:
-            data = []
-            # Header
-            a = ['Label']
-            for i in xrange(len(self.start_slope[block][self.start_slope[block].keys()[0]]['original_data'])):
-                a.append(i + 1)
-            a.append('')
-            a.append('Mean')
-            a.append('Std')
-            a.append('Number of data')
-            data.append(a)
-            # Values
-            for group in self.start_slope[block]:
-                a = [group]
-                for value in self.start_slope[block][group]['original_data']:
-                    a.append(value)
-                a.append('')
-                a.append(self.start_slope[block][group]['mean'][0])
-                a.append(self.start_slope[block][group]['std'][0])
-                a.append(self.start_slope[block][group]['len'][0])
-                data.append(a)
-            workbook.add_sheet('slope_' + self.data[block].block_name, data)
+            write_sheet(self.statistics_sheet('slope_' + self.data[block].block_name,
+                                                       self.start_slope[block]))
         #
         print save_excel_filename
         workbook.save_excel_file(save_excel_filename)
+        self.report_progress('saving', number_of_sheets + 1, number_of_sheets + 1)
         #
         return None
     ### ==================================================================== ###
-    def plot_data(self, plate_name, folder_name):
+    @profiled_stage('save_columnar_file')
+    def save_columnar_file(self, save_filename):
         """
+        HDF5 file of the traces, well labels and group statistics, an
+        alternative of the workbook for further analysis
         """
+        # h5py is only loaded when it is needed
+        from modules.columnar import save_hdf5
+        #
+        print save_filename
+        save_hdf5(self, save_filename)
+        #
+        return None
+    ### ==================================================================== ###
+    def statistics_sheet(self, name, statistics):
+        """
+        Sheet of the well values of each group with their mean, std and number
+        """
+        sheet = Sheet(name)
+        # Header
+        number_of_data = len(statistics[statistics.keys()[0]]['original_data'])
+        sheet.add_columns(['Label'], np.arange(1, number_of_data + 1)[np.newaxis, :],
+                          ['', 'Mean', 'Std', 'Number of data'])
+        # Values
+        for group in statistics:
+            sheet.add_columns([group],
+                              statistics[group]['original_data'][np.newaxis, :],
+                              ['',
+                               statistics[group]['mean'][0],
+                               statistics[group]['std'][0],
+                               statistics[group]['len'][0]])
+        #
+        return sheet
+    ### ==================================================================== ###
+    @profiled_stage('plot_data')
+    def plot_data(self, plate_name, folder_name, profile = 'publication', reuse = True):
+        """
+        Every figure (baseline, and response, slopes and mean curve of each
+        block) is an independent job, they are made by a pool of processes
+        if there are more workers. Only the statistics are sent to them.
+        profile: 'publication' or 'preview' (see modules.plot.RENDER_PROFILES)
+        reuse: figures whose inputs (statistics, names, additions, render
+               settings, the plotting code and the matplotlib version) did
+               not change since the last run are not made again
+        """
+        # matplotlib is only loaded when figures are made
+        import matplotlib
+        from modules.plot import render_settings
+        #
         folder_name = ''.join((folder_name,
                                os.path.sep,
                                plate_name.replace(' ', '_'),
@@ -437,26 +849,77 @@ class Measurement(object):
         # ---------------------------
         # Baseline
         # ---------------------------
-        print 'baseline figure...',
-        plot_baseline(self.baseline, plate_name, folder_name)
-        # ---------------------------
-        # Response
+        jobs = [('baseline', ('plot_baseline', self.baseline, plate_name, folder_name, profile))]
         # ---------------------------
-        print 'peak response figures...',
-        plot_response(self.response, plate_name, folder_name)
+        # Response and start slopes
         # ---------------------------
-        # Response
-        # ---------------------------
-        print 'start slopes figures...',
-        plot_start_slopes(self.start_slope, plate_name, folder_name)
+        for block in self.response:
+            jobs.append(('response_' + str(block + 1),
+                         ('plot_response_block', self.response[block], block, plate_name, folder_name, profile)))
+        for block in self.start_slope:
+            jobs.append(('slopes_' + str(block + 1),
+                         ('plot_start_slopes_block', self.start_slope[block], block, plate_name, folder_name,
+                          profile)))
         # ---------------------------
         # Mean curve
         # ---------------------------
-        print 'mean curve figures...',
         addition = [[0.0, 'baseline']]
         for block in xrange(1, len(self.data)):
             addition.append([self.data[block-1].time[-1], self.data[block].block_name])
-        plot_mean_curve(self.mean_time, self.mean_curve, addition, plate_name, folder_name)
+        for block in self.mean_curve:
+            jobs.append(('block_' + str(block + 1),
+                         ('plot_mean_curve_block', self.mean_time[block], self.mean_curve[block],
+                          addition, block, plate_name, folder_name, profile)))
+        # ---------------------------
+        # Skip the figures made from the same inputs
+        # ---------------------------
+        figure_cache = FigureCache(folder_name)
+        # The plotting code, the render settings and the matplotlib version
+        code_hash = data_hash([file_hash(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plot.py')),
+                               render_settings(profile),
+                               matplotlib.__version__])
+        # The mean curves keep the rows of their wells, not the traces
+        traces_hash = data_hash(self.values)
+        input_hashes = {}
+        for key, job in jobs:
+            inputs = [code_hash] + [item for item in job if item is not folder_name]
+            if job[0] == 'plot_mean_curve_block':
+                inputs.append(traces_hash)
+            input_hashes[key] = data_hash(inputs)
+        if reuse:
+            jobs = [(key, job) for key, job in jobs if not figure_cache.is_current(key, input_hashes[key])]
+        self.figures_reused = len(input_hashes) - len(jobs)
+        self.figures_rendered = len(jobs)
+        # ---------------------------
+        # The biggest figures first
+        # ---------------------------
+        jobs.sort(key = lambda item: item[1][0] != 'plot_mean_curve_block')
+        print len(jobs), 'figures,', self.figures_reused, 'reused...',
+        pool = None
+        traces_filename = None
+        temporary = False
+        if (self.workers > 1) and (len(jobs) > 1):
+            # The workers read the traces they draw from the plate values file
+            if render_settings(profile)['traces'] and any(job[0] == 'plot_mean_curve_block'
+                                                          for key, job in jobs):
+                traces_filename, temporary = self.traces_file()
+            pool = Pool(min(self.workers, len(jobs)))
+            saved = pool.imap(render_figure, (self.figure_job(job, traces_filename) for key, job in jobs))
+        else:
+            saved = imap(render_figure, (self.figure_job(job) for key, job in jobs))
+        #
+        try:
+            for done, ((key, job), filenames) in enumerate(izip(jobs, saved), 1):
+                figure_cache.update(key, input_hashes[key], filenames)
+                self.report_progress('plotting', done, len(jobs))
+        finally:
+            # The finished figures are kept even if the others are cancelled
+            figure_cache.save()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if temporary:
+                os.remove(traces_filename)
         #
         print 'DONE.'
         # 
@@ -13,11 +13,75 @@ Generate plots
 import numpy as np
 import os
 import math
-from pylab import plt
+import warnings
+import matplotlib
+# Figures are only written into files, no display is needed
+matplotlib.use('Agg')
 from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.collections import LineCollection
 import matplotlib.pyplot as plt
 
 
+# Render profiles of the figures
+#   dpi: resolution, format: file format of the figures
+#   traces: every well curve is drawn on the mean curve figures, or only
+#           their min/max envelope
+#   rasterized: the dense artists (curves) are bitmaps in vector formats
+#   baseline_pdf: the baseline figure is saved as pdf too
+RENDER_PROFILES = {'publication' : {'dpi' : 300,
+                                    'format' : 'png',
+                                    'traces' : True,
+                                    'rasterized' : False,
+                                    'baseline_pdf' : True,
+                                   },
+                   'preview' : {'dpi' : 60,
+                                'format' : 'png',
+                                'traces' : False,
+                                'rasterized' : True,
+                                'baseline_pdf' : False,
+                               },
+                  }
+
+
+def render_settings(profile = 'publication'):
+    """
+    Settings of a render profile, given by its name or as a dict
+    """
+    if isinstance(profile, dict):
+        return profile
+    if profile not in RENDER_PROFILES:
+        raise ValueError('Unknown render profile: ' + str(profile))
+    #
+    return RENDER_PROFILES[profile]
+### ======================================================================== ###
+
+def trace_envelope(statistics):
+    """
+    Min and max of the well curves of a group at each timepoint: the
+    'envelope' of the statistics if it is given, otherwise from the
+    'original_data' traces
+    """
+    if 'envelope' in statistics:
+        return statistics['envelope']
+    #
+    with warnings.catch_warnings():
+        # Timepoints without any value give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return (np.nanmin(statistics['original_data'], axis = 0),
+                np.nanmax(statistics['original_data'], axis = 0))
+### ======================================================================== ###
+
+def save_figure(fig, save_filename, settings):
+    """
+    Save and close the figure, returns the name of the file
+    """
+    save_filename = save_filename + '.' + settings['format']
+    fig.savefig(save_filename, format = settings['format'], dpi = settings['dpi'])
+    plt.close(fig)
+    #
+    return save_filename
+### ======================================================================== ###
+
 def group_similar(names):
     """
     """
@@ -83,153 +147,180 @@ def set_plot_color(index):
 
 ### ======================================================================== ###
 
-def plot_response(data, plate_name, save_folder = 'Figures/'):
+def plot_response(data, plate_name, save_folder = 'Figures/', profile = 'publication'):
     """
     """
     if not os.path.isdir(save_folder):
         os.makedirs(save_folder)
 
     for block in data:
-        #
-        group = group_similar(data[block].keys())
-        names = data[block].keys()
-        names.sort()
-        #
-        plt.figure(figsize=(16, 4 + len(names)/8), dpi=300)
-        #
-        for i, name in enumerate(names):
-            a, b, c = get_index(group, name)
-            color, pattern = color_shade_pattern(a, b, c, group)
-            mean = data[block][name]['mean'][0]
-            std = data[block][name]['std'][0]
-
-            plt.barh([i], [mean], height=1.0, color=color, hatch=pattern)
-            plt.errorbar([mean], [i+0.5], xerr=[std], ecolor = [0,0,0], linestyle = '')
-
-        plt.yticks([i+0.5 for i in xrange(len(names))], names, size = 8)
-        plt.title(plate_name)
-        plt.ylim(0, len(names))
-        plt.xlabel('change')
-        plt.tight_layout()
-
-        plt.savefig(save_folder + 'response_' + str(block + 1))
+        plot_response_block(data[block], block, plate_name, save_folder, profile)
     #
     return None
 ### ======================================================================== ###
 
-def plot_start_slopes(data, plate_name, save_folder = 'Figures/'):
+def plot_response_block(data, block, plate_name, save_folder = 'Figures/', profile = 'publication'):
+    """
+    Response figure of one block (data: the statistics of the block),
+    returns the list of the saved files
+    """
+    return plot_bars(data, plate_name, save_folder + 'response_' + str(block + 1), profile)
+### ======================================================================== ###
+
+def plot_start_slopes(data, plate_name, save_folder = 'Figures/', profile = 'publication'):
     """
     """
     if not os.path.isdir(save_folder):
         os.makedirs(save_folder)
 
     for block in data:
-        #
-        group = group_similar(data[block].keys())
-        names = data[block].keys()
-        names.sort()
-        #
-        plt.figure(figsize=(16, 4 + len(names)/8), dpi=300)
-        #
-        for i, name in enumerate(names):
-            a, b, c = get_index(group, name)
-            color, pattern = color_shade_pattern(a, b, c, group)
-            mean = data[block][name]['mean'][0]
-            std = data[block][name]['std'][0]
-
-            plt.barh([i], [mean], height=1.0, color=color, hatch=pattern)
-            plt.errorbar([mean], [i+0.5], xerr=[std], ecolor = [0,0,0], linestyle = '')
-
-        plt.yticks([i+0.5 for i in xrange(len(names))], names, size = 8)
-        plt.title(plate_name)
-        plt.ylim(0, len(names))
-        plt.xlabel('change')
-        plt.tight_layout()
-
-        plt.savefig(save_folder + 'slopes_' + str(block + 1))
+        plot_start_slopes_block(data[block], block, plate_name, save_folder, profile)
     #
     return None
 ### ======================================================================== ###
 
-def plot_mean_curve(time_data, data, additions, plate_name, save_folder = r'Figures/'):
+def plot_start_slopes_block(data, block, plate_name, save_folder = 'Figures/', profile = 'publication'):
+    """
+    Start slope figure of one block (data: the statistics of the block),
+    returns the list of the saved files
+    """
+    return plot_bars(data, plate_name, save_folder + 'slopes_' + str(block + 1), profile)
+### ======================================================================== ###
+
+def plot_bars(data, plate_name, save_filename, profile = 'publication'):
+    """
+    Horizontal bars of the group means with their std, returns the list of
+    the saved files
+    """
+    settings = render_settings(profile)
+    group = group_similar(data.keys())
+    names = data.keys()
+    names.sort()
+    #
+    fig = plt.figure(figsize=(16, 4 + len(names)/8), dpi=settings['dpi'])
+    #
+    for i, name in enumerate(names):
+        a, b, c = get_index(group, name)
+        color, pattern = color_shade_pattern(a, b, c, group)
+        mean = data[name]['mean'][0]
+        std = data[name]['std'][0]
+
+        plt.barh([i], [mean], height=1.0, color=color, hatch=pattern)
+        plt.errorbar([mean], [i+0.5], xerr=[std], ecolor = [0,0,0], linestyle = '')
+
+    plt.yticks([i+0.5 for i in xrange(len(names))], names, size = 8)
+    plt.title(plate_name)
+    plt.ylim(0, len(names))
+    plt.xlabel('change')
+    plt.tight_layout()
+
+    #
+    return [save_figure(fig, save_filename, settings)]
+### ======================================================================== ###
+
+def plot_mean_curve(time_data, data, additions, plate_name, save_folder = r'Figures/', profile = 'publication'):
     """
     """
     if not os.path.isdir(save_folder):
         os.makedirs(save_folder)
 
     for block in data:
-        #
-        group = group_similar(data[block].keys())
-        names = data[block].keys()
-        names.sort()
-        # -----------------
-        # Plot each group individualy
-        # -----------------
-        data_per_inch = 5.0
-
-        y_len = int(math.sqrt(len(names)))
-        x_len = int(np.ceil(len(names) / float(y_len)))
-
-        fig, axs = plt.subplots(y_len, x_len, sharex=True, sharey=True,
-                                figsize=(x_len*data_per_inch,y_len*data_per_inch), dpi=300)
-
-        y_min = data[block][names[0]]['original_data'].min()
-        y_max = data[block][names[0]]['original_data'].max()
-
-        for i, name in enumerate(names):
-            if data[block][name]['original_data'].min() < y_min:
-                y_min = data[block][name]['original_data'].min()
-            if data[block][name]['original_data'].max() > y_max:
-                y_max = data[block][name]['original_data'].max()
-        y_range = y_max - y_min
-                
-        for i, name in enumerate(names):
-            px = i / x_len
-            py = i % x_len
-            if y_len > 1:
-                position = (px, py)
-            else:
-                position = py
-
-            time = time_data[block][name]
-            mean = np.array(data[block][name]['mean'])
-            std = np.array(data[block][name]['std'])
-            all_curve = data[block][name]['original_data']
-
-            axs[position].plot(time, [1.0 for _ in time], 'k-')
-            for curve in all_curve:
-                axs[position].plot(time, curve, color = [0.7 for _ in xrange(3)])
-            axs[position].plot(time, mean, color = [0.2 for _ in xrange(3)], linewidth = 2.5, label = name)
-            axs[position].plot(time, mean+std, 'k--', color = [0.2 for _ in xrange(3)], linewidth = 2.5)
-            axs[position].plot(time, mean-std, 'k--', color = [0.2 for _ in xrange(3)], linewidth = 2.5)
-
-            for addition in additions[:block+1]:
-                axs[position].plot([addition[0] for _ in xrange(2)], [0.0,3.0], 'k-')
-                axs[position].text(addition[0], 0.98, addition[1], rotation=270)
+        plot_mean_curve_block(time_data[block], data[block], additions, block, plate_name, save_folder, profile)
+    #
+    return None
+### ======================================================================== ###
+
+def plot_mean_curve_block(time_data, data, additions, block, plate_name, save_folder = r'Figures/',
+                          profile = 'publication'):
+    """
+    Mean curve figure of one block (time_data, data: the time and the
+    statistics of the block), returns the list of the saved files. The
+    groups need their 'original_data' traces if the profile draws them,
+    otherwise their min/max 'envelope' is enough.
+    """
+    settings = render_settings(profile)
+    group = group_similar(data.keys())
+    names = data.keys()
+    names.sort()
+    # -----------------
+    # Plot each group individualy
+    # -----------------
+    data_per_inch = 5.0
+
+    y_len = int(math.sqrt(len(names)))
+    x_len = int(np.ceil(len(names) / float(y_len)))
+
+    fig, axs = plt.subplots(y_len, x_len, sharex=True, sharey=True,
+                            figsize=(x_len*data_per_inch,y_len*data_per_inch), dpi=settings['dpi'])
+
+    # Missing values are NaN
+    envelopes = dict((name, trace_envelope(data[name])) for name in names)
+    y_min = min([np.nanmin(envelopes[name][0]) for name in names])
+    y_max = max([np.nanmax(envelopes[name][1]) for name in names])
+    y_range = y_max - y_min
             
-            if i % x_len == 0:
-                axs[position].set_ylabel('Normalized fluorescence', size = 14)
-            if i / x_len == y_len - 1:
-                axs[position].set_xlabel('Time / sec', size = 14)
-                
-            axs[position].set_xlim(0, time[-1])
+    for i, name in enumerate(names):
+        px = i / x_len
+        py = i % x_len
+        if y_len > 1:
+            position = (px, py)
+        else:
+            position = py
+
+        time = time_data[name]
+        mean = np.array(data[name]['mean'])
+        std = np.array(data[name]['std'])
+
+        axs[position].plot([time[0], time[-1]], [1.0, 1.0], 'k-')
+        if settings['traces']:
+            # Every well curve of the group is one artist
+            all_curve = data[name]['original_data']
+            segments = np.empty((len(all_curve), len(time), 2))
+            segments[:, :, 0] = time
+            segments[:, :, 1] = all_curve
+            axs[position].add_collection(LineCollection(segments, colors = [(0.7, 0.7, 0.7)],
+                                                        rasterized = settings['rasterized']))
+        else:
+            axs[position].fill_between(time, envelopes[name][0], envelopes[name][1],
+                                       facecolor = (0.7, 0.7, 0.7), linewidth = 0.0,
+                                       rasterized = settings['rasterized'])
+        # Std band with its dashed edges
+        axs[position].fill_between(time, mean-std, mean+std, facecolor = (0.2, 0.2, 0.2),
+                                   alpha = 0.25, linewidth = 0.0)
+        axs[position].add_collection(LineCollection([np.column_stack((time, mean+std)),
+                                                     np.column_stack((time, mean-std))],
+                                                    colors = [(0.2, 0.2, 0.2)], linewidths = 2.5,
+                                                    linestyles = 'dashed'))
+        axs[position].plot(time, mean, color = [0.2 for _ in xrange(3)], linewidth = 2.5, label = name)
+
+        axs[position].vlines([addition[0] for addition in additions[:block+1]], 0.0, 3.0, colors = 'k')
+        for addition in additions[:block+1]:
+            axs[position].text(addition[0], 0.98, addition[1], rotation=270)
+        
+        if i % x_len == 0:
+            axs[position].set_ylabel('Normalized fluorescence', size = 14)
+        if i / x_len == y_len - 1:
+            axs[position].set_xlabel('Time / sec', size = 14)
+            
+        axs[position].set_xlim(0, time[-1])
 
-            for j, text in enumerate(name.split(';')):
-                axs[position].text(10, y_max - y_range*j*0.1, text, size = 14)
+        for j, text in enumerate(name.split(';')):
+            axs[position].text(10, y_max - y_range*j*0.1, text, size = 14)
 
-        axs[position].set_ylim(y_min-y_range*0.1, y_max+y_range*0.1)
-        
-#        plt.suptitle(plate_name)
-        plt.subplots_adjust(wspace = 0.01, hspace = 0.01)
-        plt.tight_layout()
-        plt.savefig(save_folder + 'block_' + str(block + 1))
+    axs[position].set_ylim(y_min-y_range*0.1, y_max+y_range*0.1)
+    
+#    plt.suptitle(plate_name)
+    plt.subplots_adjust(wspace = 0.01, hspace = 0.01)
+    plt.tight_layout()
     #
-    return None
+    return [save_figure(fig, save_folder + 'block_' + str(block + 1), settings)]
 ### ======================================================================== ###
 
-def plot_baseline(data, plate_name, save_folder = r'Figures/'):
+def plot_baseline(data, plate_name, save_folder = r'Figures/', profile = 'publication'):
     """
+    Returns the list of the saved files
     """
+    settings = render_settings(profile)
     colors = ((0.2, 0.2, 0.2),
               (0.5, 0.5, 0.5),
               (0.7, 0.7, 0.7),
@@ -237,7 +328,7 @@ def plot_baseline(data, plate_name, save_folder = r'Figures/'):
 
     names = data.keys()
     names.sort()
-    fig, axs = plt.subplots(figsize=(8,3))
+    fig, axs = plt.subplots(figsize=(8,3), dpi=settings['dpi'])
     for index, name in enumerate(names):
         for value in data[name]['original_data']:
             plot_color = colors[index % len(colors)]
@@ -265,12 +356,15 @@ def plot_baseline(data, plate_name, save_folder = r'Figures/'):
 
     save_filename = save_folder + 'baseline_average'
 
-    pdf = PdfPages(save_filename.split('.')[0] + '.pdf')
-    pdf.savefig(fig)
-    pdf.close()
+    saved = []
+    if settings['baseline_pdf'] and settings['format'] != 'pdf':
+        pdf = PdfPages(save_filename + '.pdf')
+        pdf.savefig(fig)
+        pdf.close()
+        saved.append(save_filename + '.pdf')
 
-    plt.savefig(save_filename)
+    saved.append(save_figure(fig, save_filename, settings))
     #
-    return None
+    return saved
 ### ======================================================================== ###
 
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Under GPL licence.
+
+Purpose:
+========
+Wall time, CPU time and peak memory of the pipeline stages:
+
+    with measurement.profiler.stage('calculate_response', block):
+        ...
+
+or the profiled_stage decorator on the methods of an object with a profiler
+attribute. One stage can be run under cProfile and dumped into a file.
+
+Peak memory of a stage: on Linux the peak resident memory of the process
+(VmHWM) is reset when a stage starts (/proc/self/clear_refs) and read when
+it ends, so every stage gets its own peak, even below an earlier one. The
+peaks of inner stages are added to the open outer stages. Elsewhere, or if
+clear_refs can not be written, the peak of the whole process so far is used
+(ru_maxrss): then a stage which stays below an earlier peak shows no memory
+increase. The memory of worker processes is not included.
+
+"""
+
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Linux: the peak resident memory can be reset by writing 5 into clear_refs
+CLEAR_REFS_FILENAME = '/proc/self/clear_refs'
+STATUS_FILENAME = '/proc/self/status'
+# [peak, memory at the start] of the stages running in this process, the
+# peak reset is process wide. can_reset_peak is None until it is checked.
+_open_stages = []
+_open_stages_lock = threading.Lock()
+_can_reset_peak = [None]
+
+
+def cpu_time():
+    """
+    User + system time of this process (the worker processes are not
+    included) in seconds
+    """
+    times = os.times()
+    #
+    return times[0] + times[1]
+### ======================================================================== ###
+
+def peak_memory():
+    """
+    Peak resident memory of this process in MB, None where it is not
+    available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on mac, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak / 2.0**20
+    #
+    return peak / 2.0**10
+### ======================================================================== ###
+
+def status_memory(field):
+    """
+    VmRSS (resident) or VmHWM (peak resident) memory of this process in MB
+    from /proc, None where it is not available
+    """
+    try:
+        with open(STATUS_FILENAME, 'r') as statusfile:
+            for line in statusfile:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 2.0**10
+    except (IOError, ValueError, IndexError):
+        pass
+    #
+    return None
+### ======================================================================== ###
+
+def reset_peak_memory():
+    """
+    Start a new VmHWM peak, returns False where it is not possible
+    """
+    try:
+        with open(CLEAR_REFS_FILENAME, 'w') as clear_refs:
+            clear_refs.write('5')
+    except (IOError, OSError):
+        return False
+    #
+    return True
+### ======================================================================== ###
+
+def start_memory():
+    """
+    Open a stage: returns its memory entry, [peak, memory at the start]
+    """
+    with _open_stages_lock:
+        if _can_reset_peak[0] is None:
+            _can_reset_peak[0] = reset_peak_memory() and (status_memory('VmHWM') is not None)
+        #
+        if _can_reset_peak[0]:
+            # The peak so far belongs to the outer stages
+            fold_peak_memory()
+            reset_peak_memory()
+            memory = status_memory('VmRSS')
+        else:
+            memory = peak_memory()
+        entry = [memory, memory]
+        _open_stages.append(entry)
+    #
+    return entry
+### ======================================================================== ###
+
+def finish_memory(entry):
+    """
+    Close a stage: returns its peak memory and its memory at the start
+    """
+    with _open_stages_lock:
+        if _can_reset_peak[0]:
+            fold_peak_memory()
+        else:
+            entry[0] = peak_memory()
+        # The same list, not an equal one
+        for index, open_entry in enumerate(_open_stages):
+            if open_entry is entry:
+                del _open_stages[index]
+                break
+    #
+    return entry[0], entry[1]
+### ======================================================================== ###
+
+def fold_peak_memory():
+    """
+    The peak since the last reset goes into every open stage
+    """
+    peak = status_memory('VmHWM')
+    for entry in _open_stages:
+        entry[0] = max(entry[0], peak)
+    #
+    return None
+### ======================================================================== ###
+
+def profiled_stage(name):
+    """
+    Method decorator: the whole method is a stage of self.profiler
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    #
+    return decorator
+### ======================================================================== ###
+
+
+
+
+class Profiler(object):
+    """
+    Records of the stages in the order they finished, each is a dict:
+    stage, block (None for the whole stage), wall_time, cpu_time (sec),
+    peak_memory (MB, peak during the stage) and memory_increase (MB, peak
+    during the stage above the memory at its start). See the module
+    docstring for the platforms without a per stage peak.
+    """
+    def __init__(self):
+        """
+        """
+        self.records = []
+        # Name of the stage to run under cProfile, and the file of its
+        # statistics ('<stage>.prof' if None). Every run of the stage (e.g.
+        # each block) is added to the same statistics.
+        self.profile_stage = None
+        self.profile_filename = None
+        self._profile = None
+        self._profiling = False
+        #
+        return None
+    ### ==================================================================== ###
+    @contextmanager
+    def stage(self, name, block = None):
+        """
+        Measure the code in the with statement
+        """
+        # Not inside another run of the same stage
+        profile = None
+        if (name == self.profile_stage) and (not self._profiling):
+            if self._profile is None:
+                self._profile = cProfile.Profile()
+            profile = self._profile
+            self._profiling = True
+        #
+        memory_entry = start_memory()
+        cpu_start = cpu_time()
+        wall_start = time.time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._profiling = False
+                filename = self.profile_filename
+                if filename is None:
+                    filename = name + '.prof'
+                profile.dump_stats(filename)
+            #
+            memory, memory_start = finish_memory(memory_entry)
+            self.records.append({'stage' : name,
+                                 'block' : block,
+                                 'wall_time' : time.time() - wall_start,
+                                 'cpu_time' : cpu_time() - cpu_start,
+                                 'peak_memory' : memory,
+                                 'memory_increase' : None if memory is None else memory - memory_start,
+                                })
+    ### ==================================================================== ###
+    def clear(self):
+        """
+        """
+        self.records = []
+        #
+        return None
+    ### ==================================================================== ###
+    def report(self):
+        """
+        Table of the stages as text
+        """
+        lines = ['%-28s %6s %10s %10s %10s %10s' % ('stage', 'block', 'wall (s)', 'cpu (s)',
+                                                   'peak (MB)', '+mem (MB)')]
+        for record in self.records:
+            lines.append('%-28s %6s %10.3f %10.3f %10s %10s' % (
+                         record['stage'],
+                         '' if record['block'] is None else record['block'],
+                         record['wall_time'],
+                         record['cpu_time'],
+                         '' if record['peak_memory'] is None else '%.1f' % record['peak_memory'],
+                         '' if record['memory_increase'] is None else '%.1f' % record['memory_increase']))
+        #
+        return '\n'.join(lines)
+    ### ==================================================================== ###
+    def save_json(self, filename):
+        """
+        """
+        with open(filename, 'w') as jsonfile:
+            json.dump(self.records, jsonfile, indent = 1)
+        #
+        return None
+    ### ==================================================================== ###
+    ### ==================================================================== ###
+    ### ==================================================================== ###
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Under GPL licence.
+
+Purpose:
+========
+Read the plate reader export file line by line
+
+"""
+
+import codecs
+import io
+import json
+import mmap
+import os
+
+
+# Byte order marks and the codec which decodes (and drops) them
+BYTE_ORDER_MARKS = ((codecs.BOM_UTF8, 'utf-8-sig'),
+                    (codecs.BOM_UTF16_LE, 'utf-16'),
+                    (codecs.BOM_UTF16_BE, 'utf-16'),
+                   )
+# Codec of the text after the byte order mark, used when seeking into a file
+SEEK_ENCODINGS = ((codecs.BOM_UTF8, 'utf-8'),
+                  (codecs.BOM_UTF16_LE, 'utf-16-le'),
+                  (codecs.BOM_UTF16_BE, 'utf-16-be'),
+                 )
+# Extension of the block index stored next to the measurement file
+INDEX_EXTENSION = '.index'
+
+
+def detect_encoding(filename, sample_size = 4096):
+    """
+    SoftMax exports are UTF-16 with a byte order mark, but files saved by
+    other programs may be UTF-8 or UTF-16 without the mark.
+    """
+    with open(filename, 'rb') as datafile:
+        sample = datafile.read(sample_size)
+    # ------------------------
+    # Byte order mark
+    # ------------------------
+    for mark, encoding in BYTE_ORDER_MARKS:
+        if sample.startswith(mark):
+            return encoding
+    # ------------------------
+    # UTF-16 without mark: every second byte of the ASCII text is zero
+    # ------------------------
+    if '\x00' in sample:
+        if sample[1::2].count('\x00') >= sample[0::2].count('\x00'):
+            return 'utf-16-le'
+        return 'utf-16-be'
+    #
+    return 'utf-8'
+### ======================================================================== ###
+
+def read_lines(filename):
+    """
+    Generator of the lines of the file split by tab. Only the line ending is
+    removed, the leading tabs keep every value at its column position. The
+    file is decoded on the fly, only one line is kept in memory.
+    """
+    encoding = detect_encoding(filename)
+    #
+    with io.open(filename, 'r', encoding = encoding, errors = 'replace') as datafile:
+        for line in datafile:
+            yield line.rstrip('\r\n').split('\t')
+### ======================================================================== ###
+
+def read_block_lines(lines):
+    """
+    Generator of the lines of one block at a time. A block ends with the
+    '~End' marker, its lines are handed over and forgotten right away.
+    """
+    block = []
+    for line in lines:
+        if line[0].startswith('~End'):
+            yield block
+            block = []
+        else:
+            block.append(line)
+### ======================================================================== ###
+
+def is_kinetic_plate(header):
+    """
+    Plate formated Kinetic measurement block header
+    """
+    return ((len(header) > 4) and
+            (header[3] == 'PlateFormat') and
+            (header[4] == 'Kinetic'))
+### ======================================================================== ###
+
+def seek_encoding(filename):
+    """
+    Encoding and length of the byte order mark. Any part of the file after
+    the mark can be decoded with this encoding.
+    """
+    with open(filename, 'rb') as datafile:
+        start = datafile.read(4)
+    #
+    for mark, encoding in SEEK_ENCODINGS:
+        if start.startswith(mark):
+            return encoding, len(mark)
+    #
+    return detect_encoding(filename), 0
+### ======================================================================== ###
+
+def build_block_index(filename):
+    """
+    One pass over the raw bytes to find where each block starts and ends.
+    Returns a dictionary with the encoding, the byte offsets (start, end) and
+    the name of each block.
+    """
+    encoding, mark_length = seek_encoding(filename)
+    newline = u'\n'.encode(encoding)
+    end_marker = newline + u'~End'.encode(encoding)
+    character_size = len(newline)
+    #
+    index = {'encoding' : encoding,
+             'size' : os.path.getsize(filename),
+             'mtime' : os.path.getmtime(filename),
+             'offsets' : [],
+             'names' : [],
+            }
+    #
+    with open(filename, 'rb') as datafile:
+        content = mmap.mmap(datafile.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            # ------------------------
+            # Number of blocks is in the first line
+            # ------------------------
+            start = content.find(newline) + character_size
+            first_line = content[mark_length:start].decode(encoding)
+            number_of_blocks = int(first_line.strip().split()[-1])
+            # ------------------------
+            # Blocks end at the line starting with '~End'
+            # ------------------------
+            position = start
+            while len(index['offsets']) < number_of_blocks:
+                end = content.find(end_marker, position)
+                if end < 0:
+                    break
+                # Skip matches in the middle of a character
+                if (end - mark_length) % character_size:
+                    position = end + 1
+                    continue
+                end += character_size
+                header = content[start:content.find(newline, start)].decode(encoding)
+                #
+                index['offsets'].append((start, end))
+                index['names'].append(header.strip().split('\t')[1].lower())
+                #
+                start = content.find(newline, end)
+                if start < 0:
+                    start = len(content)
+                start += character_size
+                position = start - character_size
+        finally:
+            content.close()
+    #
+    return index
+### ======================================================================== ###
+
+def load_block_index(filename):
+    """
+    Block index of the file. It is stored next to the file and rebuilt when
+    the file size or modification time changes.
+    """
+    index_filename = filename + INDEX_EXTENSION
+    #
+    try:
+        with open(index_filename, 'r') as indexfile:
+            index = json.load(indexfile)
+        if ((index['size'] == os.path.getsize(filename)) and
+            (index['mtime'] == os.path.getmtime(filename))):
+            return index
+    except (IOError, ValueError, KeyError):
+        pass
+    # ------------------------
+    # Build and store a new one, the folder may be read only
+    # ------------------------
+    index = build_block_index(filename)
+    try:
+        with open(index_filename, 'w') as indexfile:
+            json.dump(index, indexfile)
+    except IOError:
+        pass
+    #
+    return index
+### ======================================================================== ###
+
+def read_block_lines_at(filename, encoding, start, end):
+    """
+    Lines of a single block from its byte offsets, split the same way as
+    read_lines does
+    """
+    with open(filename, 'rb') as datafile:
+        datafile.seek(start)
+        text = datafile.read(end - start).decode(encoding, 'replace')
+    #
+    return [line.rstrip('\r\n').split('\t') for line in text.splitlines()]
+### ======================================================================== ###
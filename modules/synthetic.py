@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Under GPL licence.
+
+Purpose:
+========
+Synthetic plates for testing and benchmarks: SoftMax style PlateFormat /
+Kinetic exports (utf-16, tab separated) and matching label workbooks, for any
+plate format, number of blocks, time points and missing wells.
+
+"""
+
+import codecs
+import numpy as np
+import os
+import xlwt
+from modules.layout import PLATE_FORMATS
+from modules.layout import get_plate_layout
+
+
+# Default names of the blocks (additions)
+BLOCK_NAMES = ('baseline', 'drug', 'fsk', 'wash', 'control')
+
+
+def block_names(number_of_blocks):
+    """
+    """
+    return [BLOCK_NAMES[block] if block < len(BLOCK_NAMES) else 'addition' + str(block)
+            for block in xrange(number_of_blocks)]
+### ======================================================================== ###
+
+def time_text(seconds):
+    """
+    hh:mm:ss
+    """
+    seconds = int(seconds)
+    #
+    return '%02d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+### ======================================================================== ###
+
+def write_measurement_file(filename, plate_size = 96, number_of_blocks = 3, number_of_points = 20,
+                           missing_wells = (), missing_points = (3,), interval = 2.0, seed = 1):
+    """
+    Kinetic measurement in plate format.
+    number_of_points: the same for each block, or a list of one for each block
+    missing_wells: well names without values at missing_points (time point
+                   indices in every block). Wells without any value are the
+                   unused wells of the plate, so the first point always has
+                   a value.
+    """
+    layout = get_plate_layout(plate_size)
+    random = np.random.RandomState(seed)
+    if isinstance(number_of_points, int):
+        number_of_points = [number_of_points] * number_of_blocks
+    names = block_names(number_of_blocks)
+    # ---------------------------
+    # Every compound (column group) and dose (row) responds differently
+    # ---------------------------
+    effect = (1.0 + 0.05 * (layout.well_columns % 3) + 0.02 * (layout.well_rows % 2))
+    missing = np.zeros(plate_size, dtype = np.bool8)
+    if len(missing_wells) > 0:
+        missing[layout.well_indices(missing_wells)] = True
+    #
+    lines = [u'##BLOCKS= ' + unicode(number_of_blocks)]
+    for block in xrange(number_of_blocks):
+        points = number_of_points[block]
+        header = ([u'Plate:', names[block], u'1.3', u'PlateFormat', u'Kinetic', u'Fluorescence',
+                   u'FALSE', u'Raw', u'FALSE', unicode(points)] +
+                  [u''] * 8 +
+                  [unicode(layout.columns), unicode(plate_size)])
+        lines.append(u'\t'.join(header))
+        lines.append(u'\tTemperature(\xb0C)\t' +
+                     u'\t'.join(unicode(column) for column in layout.column_names) + u'\t\t')
+        # ---------------------------
+        # Time points: level of the block + slow drift + noise
+        # ---------------------------
+        level = 1000.0 * (1.0 + 0.1 * block * effect)
+        for point in xrange(points):
+            values = level + point + random.normal(0.0, 10.0, plate_size)
+            text = np.char.mod('%.1f', values).astype(object)
+            if (point > 0) and (point in missing_points):
+                text[missing] = u''
+            text = text.reshape(layout.rows, layout.columns)
+            for row in xrange(layout.rows):
+                if row == 0:
+                    start = u''.join((u'\t', time_text(point * interval), u'\t', u'%.1f' % (25.0 + 0.1 * (point % 10)),
+                                      u'\t'))
+                else:
+                    start = u'\t\t\t'
+                lines.append(start + u'\t'.join(text[row]) + u'\t\t')
+            lines.append(u'')
+        lines.append(u'~End')
+    lines.append(u'Original Filename: ' + os.path.basename(filename))
+    #
+    with codecs.open(filename, 'w', 'utf-16') as datafile:
+        datafile.write(u'\r\n'.join(lines) + u'\r\n')
+    #
+    return None
+### ======================================================================== ###
+
+def write_label_file(filename, plate_size = 96, number_of_blocks = 3, number_of_compounds = 3,
+                     number_of_doses = 2):
+    """
+    One sheet for each block: compounds by columns on the first sheet, doses
+    by rows on the second and the name of the addition on the others
+    """
+    layout = get_plate_layout(plate_size)
+    names = block_names(number_of_blocks)
+    compounds = ['ctrl'] + ['cmp' + chr(ord('A') + compound) for compound in xrange(number_of_compounds - 1)]
+    #
+    workbook = xlwt.Workbook()
+    for block in xrange(number_of_blocks):
+        sheet = workbook.add_sheet(names[block])
+        # A1 tells that the sheet belongs to a block
+        sheet.write(0, 0, names[block])
+        for column in xrange(layout.columns):
+            sheet.write(0, column + 1, column + 1)
+        for row in xrange(layout.rows):
+            sheet.write(row + 1, 0, layout.row_names[row])
+            for column in xrange(layout.columns):
+                if block == 0:
+                    label = compounds[column % number_of_compounds]
+                elif block == 1:
+                    label = 'dose' + str(row % number_of_doses)
+                else:
+                    label = names[block]
+                sheet.write(row + 1, column + 1, label)
+    workbook.save(filename)
+    #
+    return None
+### ======================================================================== ###
+
+def write_plate(folder, plate_size = 96, number_of_blocks = 3, number_of_points = 20,
+                number_of_missing_wells = 0, missing_points = (3,), seed = 1):
+    """
+    Measurement and label file of a plate in the folder, the missing wells are
+    spread evenly on the plate. Returns the two file names.
+    """
+    if plate_size not in PLATE_FORMATS:
+        raise ValueError('Unknown plate format: ' + str(plate_size) + ' wells')
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    #
+    layout = get_plate_layout(plate_size)
+    missing_wells = []
+    if number_of_missing_wells > 0:
+        step = max(plate_size // number_of_missing_wells, 1)
+        missing_wells = layout.well_names[step // 2::step][:number_of_missing_wells].tolist()
+    #
+    name = '_'.join(('plate', str(plate_size), str(number_of_blocks), str(number_of_points)))
+    datafilename = os.path.join(folder, name + '.xls')
+    label_filename = os.path.join(folder, name + '_label.xls')
+    write_measurement_file(datafilename, plate_size, number_of_blocks, number_of_points,
+                           missing_wells, missing_points, seed = seed)
+    write_label_file(label_filename, plate_size, number_of_blocks)
+    #
+    return datafilename, label_filename
+### ======================================================================== ###
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Under GPL licence.
+
+Purpose:
+========
+Reading partly filled plates: a blank well must not move the other values
+of its row. The exports differ in the number of leading tabs, both layouts
+are written here by hand.
+
+"""
+
+import codecs
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+from modules.measurement import Measurement
+
+
+# Time, temperature, and the 96 well values of each timepoint
+TIMES = (u'00:00:00', u'00:00:02', u'00:00:04')
+TEMPERATURES = (u'25.0', u'25.1', u'25.1')
+ROWS = u'ABCDEFGH'
+
+
+def well_value(block, point, row, column):
+    """
+    Every value of the file is different
+    """
+    return 1000.0 * (block + 1) + 100.0 * row + column + 0.1 * point
+### ======================================================================== ###
+
+def plate_lines(leading_tab, blank_well):
+    """
+    Text lines of a two block plate. blank_well: (row, column, timepoint) of
+    a well without value.
+    leading_tab: every line of the plate starts with an empty cell (the time
+    is the second cell), otherwise the header line is aligned with the data.
+    """
+    start = u'\t' if leading_tab else u''
+    lines = [u'##BLOCKS= 2']
+    for block, name in enumerate((u'baseline', u'addition')):
+        lines.append(u'Plate:\t' + name + u'\t1.3\tPlateFormat\tKinetic\tFluorescence\tFALSE\tRaw\tFALSE\t3\t'
+                     u'\t\t\t\t\t\t\t\t12\t96')
+        lines.append(u'\tTemperature(\xb0C)\t' + u'\t'.join(unicode(column) for column in xrange(1, 13)))
+        for point in xrange(len(TIMES)):
+            for row in xrange(8):
+                cells = [u'%.1f' % well_value(block, point, row, column) for column in xrange(12)]
+                if blank_well == (row, 0, point):
+                    cells[0] = u''
+                if row == 0:
+                    first = [TIMES[point], TEMPERATURES[point]]
+                else:
+                    first = [u'', u'']
+                lines.append(start + u'\t'.join(first + cells) + u'\t\t')
+            lines.append(u'')
+        lines.append(u'~End')
+    lines.append(u'Original Filename: plate.xls')
+    #
+    return lines
+### ======================================================================== ###
+
+
+
+
+class MissingFirstColumnWellTest(unittest.TestCase):
+    """
+    B1 is blank at the second timepoint of every block
+    """
+    def setUp(self):
+        """
+        """
+        self.folder = tempfile.mkdtemp()
+        #
+        return None
+    ### ==================================================================== ###
+    def tearDown(self):
+        """
+        """
+        shutil.rmtree(self.folder, ignore_errors = True)
+        #
+        return None
+    ### ==================================================================== ###
+    def check(self, leading_tab, workers):
+        """
+        """
+        filename = os.path.join(self.folder, 'plate.xls')
+        with codecs.open(filename, 'w', 'utf-16') as datafile:
+            datafile.write(u'\r\n'.join(plate_lines(leading_tab, (1, 0, 1))) + u'\r\n')
+        #
+        measurement = Measurement()
+        measurement.workers = workers
+        measurement.read_measurement_datafile(filename)
+        #
+        for block in xrange(2):
+            data = measurement.data[block]
+            self.assertEqual(len(data.wells), 96)
+            self.assertEqual(list(data.relative_time), [0.0, 2.0, 4.0])
+            np.testing.assert_allclose(data.temperature, [25.0, 25.1, 25.1])
+            # Blank well only at the missing timepoint
+            b1 = data.wells.index('B1')
+            self.assertTrue(np.isnan(data.raw_value[b1, 1]))
+            self.assertFalse(np.isnan(data.raw_value[b1, [0, 2]]).any())
+            # Every other well keeps its own values
+            for row in xrange(8):
+                for column in xrange(12):
+                    if (row, column) == (1, 0):
+                        continue
+                    well = data.wells.index(ROWS[row] + str(column + 1))
+                    expected = [well_value(block, point, row, column) for point in xrange(len(TIMES))]
+                    np.testing.assert_allclose(data.raw_value[well], expected, rtol = 1e-6)
+        #
+        return None
+    ### ==================================================================== ###
+    def test_aligned_sequential_reader(self):
+        """
+        """
+        self.check(False, 1)
+        #
+        return None
+    ### ==================================================================== ###
+    def test_aligned_block_index_reader(self):
+        """
+        """
+        self.check(False, 2)
+        #
+        return None
+    ### ==================================================================== ###
+    def test_leading_tab_sequential_reader(self):
+        """
+        """
+        self.check(True, 1)
+        #
+        return None
+    ### ==================================================================== ###
+    def test_leading_tab_block_index_reader(self):
+        """
+        """
+        self.check(True, 2)
+        #
+        return None
+    ### ==================================================================== ###
+    ### ==================================================================== ###
+    ### ==================================================================== ###
+
+
+if __name__ == "__main__":
+    unittest.main()